@@ -0,0 +1,188 @@
+import json
+import time
+import random
+import threading
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeReleasesServer:
+    """
+    Local stand-in for the Netflix releases api, serving synthetic {data, totalPages} pages.
+    Size, page size, latency and error rate can be changed between runs.
+    Pages are stable for a given size and epoch and carry ETag/Last-Modified, conditional requests get a 304.
+    """
+
+    def __init__(self, size: int = 100, page_size: int = 50, latency: float = 0.0, error_rate: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = 0, retry_after: Optional[float] = None,
+                 epoch: int = 4102444800):
+        """
+        :param size: number of titles in the catalogue
+        :param page_size: titles per page
+        :param latency: seconds every response is delayed
+        :param error_rate: share of responses answered with 429 or 5xx
+        :param host:
+        :param port: 0 to pick a free port
+        :param seed: seed of the error generator, so runs are comparable
+        :param retry_after: Retry-After of 429 responses in seconds, None to leave it out
+        :param epoch: start time of the first title in unix seconds, fixed so repeated crawls see the same data
+        """
+        self.size = size
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.epoch = epoch
+        # pages don't change until size, page_size or epoch do, which is the time they were last modified
+        self.modified = int(time.time())
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        # wall clock time of the first request since the last reset
+        self.first_request: Optional[float] = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def total_pages(self) -> int:
+        return max((self.size + self.page_size - 1) // self.page_size, 1)
+
+    def page(self, page: int) -> dict:
+        """
+        Build one page of releases, the payload has the shape of the real api
+        :param page:
+        :return:
+        """
+        start = self.epoch
+        data = [
+            {
+                "videoID": 80000000 + i,
+                "title1": f"Title {i}",
+                "title2": f"Title {i}",
+                "startTime": (start + i * 60) * 1000,
+                "genre": i % 40,
+                "collection": i % 7,
+                "country": "US",
+                "image": f"https://occ-0-0-0.1.nflxso.net/dnm/api/v6/{i}.jpg",
+            }
+            for i in range((page - 1) * self.page_size, min(page * self.page_size, self.size))
+        ]
+        return {"data": data, "totalPages": self.total_pages}
+
+    def etag(self, page: int) -> str:
+        return f'"{self.epoch}-{self.size}-{self.page_size}-{page}"'
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.not_modified = 0
+            self.first_request = None
+            self.modified = int(time.time())
+
+    def _unchanged(self, headers, etag: str) -> bool:
+        """
+        Whether a conditional request matches the current page, If-None-Match wins over If-Modified-Since
+        :param headers: request headers
+        :param etag:
+        :return:
+        """
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            if self.first_request is None:
+                self.first_request = time.time()
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                if server._fail():
+                    status = server._random.choice((429, 500, 502, 503, 504))
+                    self.send_response(status)
+                    if status == 429 and server.retry_after is not None:
+                        self.send_header("Retry-After", f"{server.retry_after:g}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                page = int(query.get("page", ["1"])[0])
+                etag = server.etag(page)
+                if server._unchanged(self.headers, etag):
+                    with server._lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = json.dumps(server.page(page)).encode()
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", formatdate(server.modified, usegmt=True))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                ...
+
+        return Handler
+
+    def start(self) -> "FakeReleasesServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-releases", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve synthetic Netflix releases")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    with FakeReleasesServer(args.size, args.page_size, args.latency, args.error_rate, port=args.port) as fake:
+        print(f"Serving {fake.size} titles on {fake.base_url}/api/data/releases")
+        threading.Event().wait()
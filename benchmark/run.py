@@ -0,0 +1,209 @@
+"""
+End to end benchmark of the Netflix crawl, notification rendering and SQL upserts against a local fake api.
+Run from the project root: python -m benchmark.run --sizes 100,1000,10000,100000
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+from benchmark.fake_server import FakeReleasesServer
+
+# stages compared against a baseline, higher is better
+THROUGHPUT = ("crawl_per_s", "render_per_s", "sql_per_s")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile
+    :param values:
+    :param pct: 0-100
+    :return:
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(max(round(pct / 100 * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+def write_config(workdir: Path, base_url: str, concurrency: int) -> Path:
+    """
+    Write the configuration used by the benchmark, nothing is cached on disk so every page is fetched
+    :param workdir:
+    :param base_url:
+    :param concurrency:
+    :return:
+    """
+    path = workdir / "config.yaml"
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump({
+            "log": {"enable": False},
+            "http": {"cache": {"enable": False}, "rate_limit": {"enable": False}, "backoff_factor": 0.1},
+            "dedup": {"enable": True, "db_path": str(workdir / "dedup.db")},
+            "scheduler": {"enable": False},
+            "services": {
+                "netflix": {"enable": True, "concurrency": concurrency, "extra_config": {"base_url": base_url}},
+            },
+        }, f)
+    return path
+
+
+def run(size: int, server: FakeReleasesServer, workdir: Path, memory: bool, streaming: bool = False) -> dict:
+    """
+    Crawl, render and upsert a catalogue of the given size with a fresh service, dedup index and database
+    :param size: number of titles
+    :param server:
+    :param workdir:
+    :param memory: trace peak memory, slows the run down
+    :param streaming: crawl page by page like the streaming mode, first_s is then the time to the first page
+    :return: results of the run
+    """
+    from utils import sql
+    from utils.config import config, SQLiteConfig
+    from services.netflix import Netflix
+
+    latencies = []
+
+    class BenchNetflix(Netflix):
+        def get_details(self, page=1, target=None) -> dict:
+            start = time.perf_counter()
+            try:
+                return super().get_details(page, target)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    server.size = size
+    server.reset()
+    config.dedup.db_path = str(workdir / f"dedup_{size}.db")
+    engine = sql.create_service_engine("sqlite", SQLiteConfig(db_path=str(workdir / f"bench_{size}.db")))
+    sql.create_db(engine)
+    if memory:
+        tracemalloc.start()
+    service = BenchNetflix(config.services["netflix"])
+
+    start = time.perf_counter()
+    if streaming:
+        first = None
+        for _ in service.iter_request():
+            first = first or time.perf_counter() - start
+    else:
+        service.request()
+    crawl = time.perf_counter() - start
+    first = (first or crawl) if streaming else crawl
+
+    start = time.perf_counter()
+    msgs = service.get_notification_msgs(msg_format="markdown", notification_obj=SimpleNamespace(name="benchmark"))
+    render = time.perf_counter() - start
+
+    start = time.perf_counter()
+    session = sql.get_session(engine)
+    try:
+        for query in service.get_sql_query(session):
+            session.execute(query)
+        session.commit()
+    finally:
+        session.close()
+    upsert = time.perf_counter() - start
+
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    engine.dispose()
+    items = len(service.results)
+    return {
+        "size": size,
+        "items": items,
+        "pages": server.total_pages,
+        "requests": server.requests,
+        "errors": server.errors,
+        "first_s": first,
+        "crawl_s": crawl,
+        "crawl_per_s": items / crawl if crawl else 0,
+        "fetch_p50_ms": percentile(latencies, 50) * 1000,
+        "fetch_p99_ms": percentile(latencies, 99) * 1000,
+        "render_s": render,
+        "render_per_s": len(msgs) / render if render else 0,
+        "sql_s": upsert,
+        "sql_per_s": items / upsert if upsert else 0,
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+def report(results: list[dict]):
+    # column -> format spec
+    columns = {
+        "size": "d", "items": "d", "requests": "d", "errors": "d", "first_s": ".2f", "crawl_s": ".2f", "crawl_per_s": ".0f",
+        "fetch_p50_ms": ".1f", "fetch_p99_ms": ".1f", "render_per_s": ".0f", "sql_per_s": ".0f", "peak_mb": ".1f",
+    }
+    print(" ".join(f"{name:>12}" for name in columns))
+    for result in results:
+        print(" ".join(f"{result[name]:>12{spec}}" for name, spec in columns.items()))
+
+
+def compare(results: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    """
+    Compare throughput with a previous run
+    :param results:
+    :param baseline_path: json written by --output
+    :param tolerance: allowed relative slowdown, e.g. 0.2 for 20%
+    :return: regressions found
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result["size"]: result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["size"])
+        if not previous:
+            continue
+        for name in THROUGHPUT:
+            if previous[name] and result[name] < previous[name] * (1 - tolerance):
+                regressions.append(f"size {result['size']}: {name} {result[name]:.0f} < {previous[name]:.0f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark crawl, render and SQL upserts against a fake api")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="comma separated catalogue sizes")
+    parser.add_argument("--page-size", type=int, default=50, help="titles per page")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds every response is delayed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of responses answered with 429/5xx")
+    parser.add_argument("--retry-after", type=float, help="Retry-After of 429 responses, in seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="pages fetched in parallel")
+    parser.add_argument("--no-memory", action="store_true", help="don't trace peak memory, tracing slows runs down")
+    parser.add_argument("--streaming", action="store_true", help="crawl page by page, see services.*.streaming")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json written by --output, exit 1 when throughput regresses")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    server = FakeReleasesServer(page_size=args.page_size, latency=args.latency, error_rate=args.error_rate,
+                                retry_after=args.retry_after)
+    with server, tempfile.TemporaryDirectory(prefix="sum-bench-") as workdir:
+        # the configuration is loaded on import, so it has to be in place before the project modules are imported
+        os.environ["SUM_CONFIG"] = str(write_config(Path(workdir), server.base_url, args.concurrency))
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+        results = [run(int(size), server, Path(workdir), not args.no_memory, args.streaming)
+                   for size in args.sizes.split(",")]
+
+    report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
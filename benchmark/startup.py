@@ -0,0 +1,63 @@
+"""
+Startup benchmark of one-shot runs (main.py --once) with a stdout only configuration.
+Startup is the time from spawning the process to its first request to the fake api.
+Run from the project root: python -m benchmark.startup --runs 5
+"""
+import sys
+import time
+import yaml
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from benchmark.fake_server import FakeReleasesServer
+
+ROOT = Path(__file__).resolve().parent.parent
+# seconds from spawning `main.py --once` to its first request, with a stdout only configuration
+STARTUP_TARGET = 0.6
+
+
+def write_config(workdir: Path, base_url: str) -> Path:
+    path = workdir / "config.yaml"
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump({
+            "log": {"enable": False},
+            "http": {"cache": {"enable": False}, "rate_limit": {"enable": False}},
+            "dedup": {"enable": False},
+            "scheduler": {"enable": False},
+            "services": {"netflix": {"enable": True, "extra_config": {"base_url": base_url}}},
+            "notifications": [{"enable": True, "type": "stdout", "config": {"immediate_send": True}}],
+        }, f)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of one-shot runs")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--size", type=int, default=100, help="titles served by the fake api")
+    parser.add_argument("--target", type=float, default=STARTUP_TARGET,
+                        help="exit 1 when the median startup is slower, in seconds")
+    args = parser.parse_args()
+
+    startups, totals = [], []
+    with FakeReleasesServer(size=args.size) as server, tempfile.TemporaryDirectory(prefix="sum-bench-") as workdir:
+        env = {"SUM_CONFIG": str(write_config(Path(workdir), server.base_url)), "PATH": ""}
+        for _ in range(args.runs):
+            server.reset()
+            start = time.time()
+            subprocess.run([sys.executable, str(ROOT / "main.py"), "--once"], cwd=ROOT, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            totals.append(time.time() - start)
+            startups.append(server.first_request - start)
+
+    startup = statistics.median(startups)
+    print(f"startup median {startup * 1000:.0f} ms (min {min(startups) * 1000:.0f} ms, target {args.target * 1000:.0f} ms)")
+    print(f"run median {statistics.median(totals) * 1000:.0f} ms")
+    if startup > args.target:
+        print(f"REGRESSION startup {startup * 1000:.0f} ms > {args.target * 1000:.0f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,23 @@
 import sys
 import time
-from utils import sql
+import signal
+import argparse
 from loguru import logger
+from utils import polling
 from datetime import datetime
+from contextlib import closing
 from utils.config import config
+from utils.metrics import metrics
+from utils.dispatcher import dispatcher
 from services import Service_T, ServiceMap
-from utils.scheduler import scheduler, add_job
-from sqlalchemy.orm.session import sessionmaker
-from apscheduler.triggers.date import DateTrigger
+from typing import Optional, TYPE_CHECKING
+from utils.base_object import NotificationMSG
+from utils.singleflight import SingleFlight, claim
 from notification import Notification_T, NotificationMap
-from apscheduler.triggers.interval import IntervalTrigger
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+if TYPE_CHECKING:
+    from utils.writer import DBWriter
 
 if sys.flags.debug or sys.gettrace():
     import utils.debug_log
@@ -31,20 +39,25 @@ def init_services() -> list[Service_T]:
     return service_list
 
 
-def init_database() -> list[sessionmaker]:
+def init_database() -> list["DBWriter"]:
     """
-    Initialize database
+    Initialize database and start a background writer for each
     :return:
     """
     db_list = []
     if not config.db:
         return db_list
+    # sqlalchemy and the database drivers are only imported when a database is enabled
+    from utils import sql
+    from utils.writer import DBWriter
     for db in config.db:
         if not db.enable:
             continue
         engine = sql.create_service_engine(db.type, db.config)
         sql.create_db(engine)
-        db_list.append(sql.get_session_factory(engine))
+        writer = DBWriter(sql.get_session_factory(engine), db)
+        writer.start()
+        db_list.append(writer)
     return db_list
 
 
@@ -54,84 +67,319 @@ def init_notification() -> list[Notification_T]:
     :return:
     """
     notification_list = []
-    for notification in config.notifications:
+    for index, notification in enumerate(config.notifications):
         if not notification.enable:
             continue
         if notification.type.lower() not in NotificationMap:
             logger.warning(f"Notification {notification.type} not found")
             continue
         n = NotificationMap[notification.type.lower()](notification.config)
+        n.name = notification.name or f"{notification.type.lower()}_{index}"
         n.configuration(config=notification.config)
         notification_list.append(n)
     return notification_list
 
 
+def deliver(n: Notification_T, msgs: list[NotificationMSG]) -> bool:
+    """
+    Send or schedule the messages of one notification
+    :param n:
+    :param msgs:
+    :return: whether every immediate message was sent
+    """
+    immediate = []
+    scheduled = []
+    for msg in msgs:
+        if n.config.get("immediate_send"):
+            immediate.append(msg)
+        else:
+            if msg.send_time < datetime.now():
+                logger.error("Send time is earlier than now, will not send")
+                continue
+            if n.config.get("update_send_time"):
+                scheduled.append((msg, msg.send_time.replace(hour=0, minute=0, second=0, microsecond=0)))
+            else:
+                scheduled.append((msg, msg.send_time))
+    dispatcher.schedule(n, scheduled)
+    return dispatcher.send(n, immediate)
+
+
 def monitor_service(_service: Service_T):
     """
     Monitor service
     :param _service:
     :return:
     """
-    notification_list = [hash(x.__class__.__name__) for x in __notifications]
-    db_list = [hash(x.kw.get("bind").url) for x in __dbs]
-    _service.request(notification_list=notification_list, db_list=db_list)
-    if len(__notifications) > 0:
-        for n in __notifications:
-            for msg in _service.get_notification_msgs(msg_format=n.config.get("msg_format", "text"), notification_obj=n):
-                if n.config.get("immediate_send"):
-                    if n.send_msg(msg):
-                        logger.info(f"Send notification success")
-                    else:
-                        logger.error(f"Send notification failed")
-                else:
-                    if msg.send_time < datetime.now():
-                        logger.error("Send time is earlier than now, will not send")
-                        continue
-                    if n.config.get("update_send_time"):
-                        _trigger = DateTrigger(run_date=msg.send_time.replace(hour=0, minute=0, second=0, microsecond=0))
-                    else:
-                        _trigger = DateTrigger(run_date=msg.send_time)
-                    add_job(n.send_msg, _trigger, kwargs={"msg": msg}, name=msg.name)
+    name = _service.__class__.__name__
+    with flights.lead(name) as leader:
+        if not leader:
+            logger.warning(f"{name} is still running, this run is coalesced into it")
+            metrics.inc("sum_runs_coalesced_total", service=name)
+            return
+        with claim(f"service:{name}") as claimed:
+            if not claimed:
+                logger.info(f"{name} is crawled by another node, this run is skipped")
+                metrics.inc("sum_runs_claimed_elsewhere_total", service=name)
+                return
+            with metrics.timer("monitor", service=name):
+                start_times = _monitor_service(_service)
+        if _service.config.adaptive:
+            polling.observe(name, _service.config, start_times)
+            if config.scheduler.enable:
+                schedule_service(_service)
+    if config.metrics.textfile:
+        metrics.dump(config.metrics.textfile)
+
+
+def _monitor_service(_service: Service_T) -> list[datetime]:
+    """
+    Crawl a service and deliver what it found
+    :param _service:
+    :return: start times of the new and changed releases of the crawl, only collected with adaptive polling
+    """
+    started = time.monotonic()
+    position = _service.results.total
+    start_times = []
+    if _service.config.streaming:
+        # every page with new releases is delivered before the crawl goes on, a slow sink slows the crawl down
+        first = True
+        # closed right away on an error, so the crawl is stopped before the run ends
+        with closing(_service.iter_request()) as pages:
+            for _ in pages:
+                if _service.config.adaptive:
+                    # only the start times are kept, so delivered releases can be evicted
+                    start_times.extend(release.start_time for release in _service.results.since(position)
+                                       if release.change in _service.events)
+                    position = _service.results.total
+                deliver_pending(_service, block=True)
+                if first:
+                    metrics.set("sum_first_delivery_seconds", time.monotonic() - started,
+                                service=_service.__class__.__name__)
+                    first = False
+                _service.results.evict()
+    else:
+        _service.request()
+        if _service.config.adaptive:
+            start_times = [release.start_time for release in _service.results.since(position)
+                           if release.change in _service.events]
+        deliver_pending(_service)
+        metrics.set("sum_first_delivery_seconds", time.monotonic() - started, service=_service.__class__.__name__)
+    for n in __notifications:
+        logger.info(f"Notification {n.name}: {n.sent} sent, {n.failed} failed")
+    return start_times
+
+
+def deliver_pending(_service: Service_T, block: bool = False):
+    """
+    Deliver the releases every sink has not consumed yet
+    :param _service:
+    :param block: wait for room in the database queues instead of spilling right away
+    :return:
+    """
+    futures = {}
+    for n in __notifications:
+        # messages are collected here, only the delivery runs on the sink executor
+        msgs = _service.get_notification_msgs(msg_format=n.config.get("msg_format", "text"), notification_obj=n)
+        if msgs:
+            futures[n] = (time.monotonic() + n.config.get("sink_timeout", 120), __sink_executor.submit(deliver, n, msgs))
     if len(__dbs) > 0:
-        for session_maker in __dbs:
-            session = session_maker()
-            queries = _service.get_sql_query(session)
-            for q in queries:
-                session.add(q)
-            session.commit()
-            session.close()
-
-
-# init services
-__services = init_services()
-if len(__services) == 0:
-    logger.error("No services enabled, will exit")
-    exit(1)
-# init database
-__dbs = init_database()
-if len(__dbs) == 0:
-    logger.error("No database enabled, will not save data")
-# init notification
-__notifications = init_notification()
-if len(__notifications) == 0:
-    logger.error("No notification enabled, will not send notification")
-
-
-# run once
-for service in __services:
-    monitor_service(_service=service)
-
-# start scheduler
-if config.scheduler.enable:
-    for service in __services:
-        trigger = IntervalTrigger(minutes=service.config.interval)
-        add_job(monitor_service, trigger, kwargs={"_service": service})
+        # written in the background, a slow database doesn't hold up the next run
+        for writer in __dbs:
+            rows = _service.get_sql_rows(writer.sink)
+            writer.put(_service.sql_model, rows, timeout=writer.config.put_timeout if block else 0)
+    for n, (deadline, future) in futures.items():
+        try:
+            future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            logger.error(f"Notification {n.name} did not finish in time, leaving it in the background")
+        except Exception as e:
+            n.count(False)
+            logger.error(f"Notification {n.name} failed: {e!r}")
+
+
+def seed_polling(_service: Service_T, limit: int = 100):
+    """
+    Seed adaptive polling with the next releases stored in the first database, so a restart keeps watching them
+    :param _service:
+    :param limit: number of upcoming releases loaded
+    :return:
+    """
+    from sqlalchemy import select
+    from sqlalchemy.exc import SQLAlchemyError
+
+    model = _service.sql_model
+    try:
+        with __dbs[0].session_maker.kw.get("bind").connect() as conn:
+            start_times = conn.execute(
+                select(model.release_time).where(model.release_time > datetime.now())
+                .order_by(model.release_time).limit(limit)
+            ).scalars().all()
+    except SQLAlchemyError as e:
+        logger.error(f"Failed to load upcoming releases of {model.__tablename__}: {e}")
+        return
+    polling.seed(_service.__class__.__name__, _service.config, start_times)
+
+
+def schedule_service(_service: Service_T):
+    """
+    Schedule a service on its current interval, an adaptive service is rescheduled when its interval changes
+    :param _service:
+    :return:
+    """
+    from utils.scheduler import add_job
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    minutes = polling.interval(_service.__class__.__name__, _service.config)
+    add_job(monitor_service, IntervalTrigger(minutes=minutes), kwargs={"_service": _service})
+
+
+def run_scheduler(services: list[Service_T]):
+    """
+    Run every service on its interval until the scheduler stops
+    :param services:
+    :return:
+    """
+    from utils.scheduler import get_scheduler
+
+    for service in services:
+        schedule_service(service)
     logger.info("Scheduler started")
+    scheduler = get_scheduler()
     while True:
         if not scheduler.running:
             logger.error("Scheduler stopped, will exit")
             break
         scheduler.print_jobs()  # print jobs for debug
         time.sleep(3600)
-else:
-    logger.info("Scheduler is disabled. Run once and quite.")
+
+
+def export(args: argparse.Namespace) -> int:
+    """
+    Export the stored releases of a database
+    :param args: arguments of the export command
+    :return: exit code
+    """
+    if args.output == "-":
+        # the rows are written to stdout, keep the logs out of them
+        logger.remove()
+        logger.add(sys.stderr, level="INFO")
+    dbs = [db for db in config.db if db.enable]
+    if args.db >= len(dbs):
+        logger.error(f"Database {args.db} is not enabled, {len(dbs)} databases are enabled")
+        return 1
+    from utils import sql
+    from utils.export import export as export_rows
+    engine = sql.create_service_engine(dbs[args.db].type, dbs[args.db].config)
+    try:
+        export_rows(engine, args.output, args.format, since=args.since, until=args.until, region=args.region,
+                    video_ids=args.video_ids, batch_size=args.batch_size)
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"Export failed: {e}")
+        return 1
+    return 0
+
+
+def main():
+    global __services, __dbs, __notifications, __sink_executor
+    parser = argparse.ArgumentParser(description="Monitor streaming services for new releases")
+    parser.add_argument("--once", action="store_true",
+                        help="run every service once and exit, e.g. from cron, the scheduler is never started")
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="stream the stored releases of a database to a file")
+    export_parser.add_argument("--format", default="ndjson", choices=("ndjson", "csv", "parquet"),
+                               help="parquet needs pyarrow")
+    export_parser.add_argument("--output", default="-", help="file path, - for stdout")
+    export_parser.add_argument("--db", type=int, default=0, help="index of the database among the enabled ones")
+    export_parser.add_argument("--since", type=datetime.fromisoformat, help="release time lower bound, inclusive")
+    export_parser.add_argument("--until", type=datetime.fromisoformat, help="release time upper bound, exclusive")
+    export_parser.add_argument("--region", default="", help="country the release was found in, e.g. US")
+    export_parser.add_argument("--video-id", type=int, action="append", dest="video_ids", help="repeatable")
+    export_parser.add_argument("--batch-size", type=int, default=1000, help="rows per page")
+    args = parser.parse_args()
+    if args.command == "export":
+        sys.exit(export(args))
+    if args.once:
+        config.scheduler.enable = False
+
+    # init services
+    __services = init_services()
+    if len(__services) == 0:
+        logger.error("No services enabled, will exit")
+        sys.exit(1)
+    # init database
+    __dbs = init_database()
+    if len(__dbs) == 0:
+        logger.error("No database enabled, will not save data")
+    # init notification
+    __notifications = init_notification()
+    if len(__notifications) == 0:
+        logger.error("No notification enabled, will not send notification")
+    outbox = None
+    if __dbs and config.outbox.enable:
+        from utils.outbox import Outbox
+        # notifications are kept in the first database, they are retried across restarts
+        outbox = Outbox(__dbs[0].session_maker.kw.get("bind"), config.outbox)
+    if config.cluster.enable and outbox is None:
+        logger.warning("The cluster is enabled without an outbox, scheduled notifications are only kept by this node")
+    dispatcher.start(__notifications, outbox)
+    if config.metrics.enable:
+        metrics.serve(config.metrics.host, config.metrics.port)
+    # sinks are delivered to concurrently, a slow one doesn't hold up the others
+    __sink_executor = ThreadPoolExecutor(max_workers=max(len(__notifications), 1), thread_name_prefix="sink")
+
+    # releases stored before a restart are not new to the next crawl, polling learns about them here
+    if __dbs:
+        for service in __services:
+            if service.config.adaptive and service.sql_model is not None:
+                seed_polling(service)
+
+    # SIGTERM unwinds like Ctrl+C, so the queued rows are written or spilled below
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        # run once
+        for service in __services:
+            monitor_service(_service=service)
+
+        # start scheduler
+        if config.scheduler.enable:
+            run_scheduler(__services)
+        else:
+            # without a scheduler, messages scheduled by previous runs are sent once they are due
+            dispatcher.dispatch()
+            logger.info("Scheduler is disabled. Run once and quite.")
+    except KeyboardInterrupt:
+        logger.info("Interrupted, shutting down")
+    finally:
+        shutdown()
+
+
+def terminate(signum, frame):
+    logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+    raise SystemExit(128 + signum)
+
+
+def shutdown():
+    """
+    Let the runs in progress finish, then write or spill what the database writers still hold
+    :return:
+    """
+    from utils import scheduler
+
+    if scheduler.scheduler and scheduler.scheduler.running:
+        scheduler.scheduler.shutdown(wait=True)
+    # let deliveries that outlived their timeout finish before exiting
+    if __sink_executor:
+        __sink_executor.shutdown()
+    for writer in __dbs:
+        writer.stop()
+
+
+# overlapping runs of a service, e.g. a slow crawl running into the next interval, coalesce
+flights = SingleFlight()
+__services: list[Service_T] = []
+__dbs: list["DBWriter"] = []
+__notifications: list[Notification_T] = []
+__sink_executor: Optional[ThreadPoolExecutor] = None
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
+from loguru import logger
 from apprise import Apprise
+from concurrent.futures import ThreadPoolExecutor, wait
 from utils.base_object import Notification, NotificationMSG
 
 
@@ -6,6 +8,8 @@ class AppriseN(Notification):
     def __init__(self, notification_config):
         super().__init__(notification_config)
         self.apo = Apprise()
+        # seconds to wait for one service url
+        self.timeout = notification_config.get("timeout", 30)
 
     def configuration(self, *args, **kwargs):
         config = kwargs.get("config", {})
@@ -14,8 +18,89 @@ class AppriseN(Notification):
             self.apo.add(service)
 
     def send_msg(self, msg: NotificationMSG, *args, **kwargs):
-        return self.apo.notify(
-            title=msg.title,
-            body=msg.body,
-            tag=msg.tag,
-        )
+        return self.notify(msg.title, [msg.body], "", msg.tag)
+
+    def send_batch(self, msgs: list[NotificationMSG], *args, **kwargs) -> bool:
+        """
+        With digest enabled, merge the messages into one notification, split to fit each service.
+        :param msgs:
+        :return:
+        """
+        if not self.config.get("digest") or len(msgs) == 1:
+            return super().send_batch(msgs)
+        separator = "<br><br>" if msgs[0].msg_format == "html" else "\n\n"
+        title = f"{msgs[0].title} ({len(msgs)})"
+        return self.notify(title, [msg.body for msg in msgs], separator, msgs[0].tag)
+
+    @staticmethod
+    def split(bodies: list[str], separator: str, limit: int) -> list[str]:
+        """
+        Join bodies with the separator into as few chunks as possible that are at most limit long
+        :param bodies:
+        :param separator:
+        :param limit: max chunk length, 0 for unlimited
+        :return:
+        """
+        if not limit:
+            return [separator.join(bodies)]
+        chunks = []
+        current = ""
+        for body in bodies:
+            # a single body longer than the limit is cut
+            while len(body) > limit:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(body[:limit])
+                body = body[limit:]
+            candidate = f"{current}{separator}{body}" if current else body
+            if len(candidate) > limit:
+                chunks.append(current)
+                current = body
+            else:
+                current = candidate
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _deliver(self, service, title: str, bodies: list[str], separator: str) -> bool:
+        for body in self.split(bodies, separator, service.body_maxlen):
+            if not service.notify(title=title, body=body):
+                return False
+        return True
+
+    def notify(self, title: str, bodies: list[str], separator: str, tag: list[str]) -> bool:
+        """
+        Deliver to every matching service url concurrently, waiting at most self.timeout seconds
+        :param title:
+        :param bodies: message bodies, joined with the separator as long as the service allows
+        :param separator:
+        :param tag:
+        :return: whether every service url succeeded
+        """
+        services = list(self.apo.find(tag=tag))
+        if not services:
+            logger.warning("No apprise service url matches, nothing sent")
+            return False
+
+        # plain threads instead of async_notify, which runs on the event loop's default executor with apprise 1.x,
+        # so closing the loop waits for a hanging url. a url still running after the timeout is left behind
+        executor = ThreadPoolExecutor(max_workers=len(services), thread_name_prefix="apprise")
+        futures = {executor.submit(self._deliver, service, title, bodies, separator): service for service in services}
+        done, _ = wait(futures, timeout=self.timeout)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        success = True
+        for future, service in futures.items():
+            if future in done and not future.exception() and future.result():
+                logger.debug(f"Apprise {service.url(privacy=True)} notified")
+                continue
+            success = False
+            if future not in done:
+                reason = f"timed out after {self.timeout}s"
+            elif future.exception():
+                reason = repr(future.exception())
+            else:
+                reason = "rejected by the service"
+            logger.error(f"Apprise {service.url(privacy=True)} failed: {reason}")
+        return success
@@ -1,12 +1,24 @@
-from .Apprise import AppriseN
-from .stdout import STDOutput
-from typing import Union
+from typing import TYPE_CHECKING, Union
+from utils.lazy import LazyMap, resolve
 
-Notification_T = Union[AppriseN]
-NotificationMap = {
-    "stdout": STDOutput,
-    "apprise": AppriseN,
-}
+if TYPE_CHECKING:
+    from .Apprise import AppriseN
+    from .stdout import STDOutput
 
-__all__ = ["Notification_T", "NotificationMap"]
+Notification_T = Union["AppriseN", "STDOutput"]
+# notifications are only imported once they are enabled, apprise and its plugins are slow to import
+NotificationMap = LazyMap({
+    "stdout": "notification.stdout:STDOutput",
+    "apprise": "notification.Apprise:AppriseN",
+})
+
+
+def __getattr__(name: str):
+    # keeps `from notification import AppriseN` working
+    for path in NotificationMap.paths.values():
+        if path.endswith(f":{name}"):
+            return resolve(path)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+
+__all__ = ["Notification_T", "NotificationMap"]
@@ -1,10 +1,22 @@
-from typing import Union
-from .netflix import Netflix
+from typing import TYPE_CHECKING, Union
+from utils.lazy import LazyMap, resolve
 
-Service_T = Union[Netflix]
-ServiceMap = {
-    "netflix": Netflix,
-}
+if TYPE_CHECKING:
+    from .netflix import Netflix
 
-__all__ = ("Netflix", "Service_T", "ServiceMap")
+Service_T = Union["Netflix"]
+# services are only imported once they are enabled
+ServiceMap = LazyMap({
+    "netflix": "services.netflix:Netflix",
+})
+
+
+def __getattr__(name: str):
+    # keeps `from services import Netflix` working
+    for path in ServiceMap.paths.values():
+        if path.endswith(f":{name}"):
+            return resolve(path)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+
+__all__ = ("Netflix", "Service_T", "ServiceMap")
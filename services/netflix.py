@@ -1,26 +1,128 @@
 import json
+import queue
+import hashlib
+import threading
 from loguru import logger
-from datetime import datetime
-from utils.sql import NetflixSQL
-from sqlalchemy.orm import Session
+from functools import partial
+from utils.store import Release
+from utils.metrics import metrics
+from utils.lazy import LazyAttribute
+from datetime import datetime, timedelta
 from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
 from utils.base_object import Service, NotificationMSG
+from typing import Callable, Iterator, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+
+# service name -> time of the last complete full crawl, kept for the process like utils.polling, a persistent
+# job store hands every run a fresh copy of the service
+_last_full_crawl: dict[str, datetime] = {}
+# url -> (body digest, totalPages) of the last processed response, kept for the process for the same reason
+_page_digests: dict[str, tuple[str, int]] = {}
+
+
+class Added:
+    """
+    Release added by the running crawl, the release itself may be delivered and evicted before the crawl ends
+    """
+    __slots__ = ("position", "regions", "rank")
+
+    def __init__(self, position: int, regions: list[str], rank: int):
+        # absolute position of the latest release of the key in the store
+        self.position = position
+        # regions merged so far, in the configured order
+        self.regions = regions
+        # index of the target the fields of the release come from, -1 if they must not be replaced
+        self.rank = rank
 
 
 class Netflix(Service):
+    sql_model = LazyAttribute("utils.sql:NetflixSQL")
+    templates = {
+        "text": {
+            "title": "$service $event",
+            "body": "Release Name: $name\n"
+                    "video_id: $video_id\n"
+                    "start_time: $start_time\n"
+                    "image: $image\n"
+                    "collection_id: $collection_id\n"
+                    "genre_id: $genre_id\n"
+                    "country: $country\n"
+                    "regions: $regions\n"
+                    "url: $url",
+        },
+        "markdown": {
+            "title": "$service $event",
+            "body": "*Release Name:* $name\n"
+                    "*video_id:* $video_id\n"
+                    "*start_time:* $start_time\n"
+                    "*image:* [Image]($image)\n"
+                    "*collection_id:* $collection_id\n"
+                    "*genre_id:* $genre_id\n"
+                    "*country:* $country\n"
+                    "*regions:* $regions\n"
+                    "*url:* $url",
+        },
+        "html": {
+            "title": "$service $event",
+            "body": "<b>Release Name:</b> $name<br>"
+                    "<b>video_id:</b> $video_id<br>"
+                    "<b>start_time:</b> $start_time<br>"
+                    "<b>image:</b> <a href='$image'>Image</a><br>"
+                    "<b>collection_id:</b> $collection_id<br>"
+                    "<b>genre_id:</b> $genre_id<br>"
+                    "<b>country:</b> $country<br>"
+                    "<b>regions:</b> $regions<br>"
+                    "<b>url:</b> $url",
+        },
+    }
+
+    # change -> columns updated in the stored row of a known release
+    update_columns = {
+        "rescheduled": ["release_time", "regions"],
+        "updated": ["name", "release_time", "collection", "genre", "image", "regions"],
+        "regions": ["regions"],
+        # fields of a target listed before the one the release was delivered with, the country is kept
+        # since it's part of the unique key of the row
+        "merged": ["name", "release_time", "collection", "genre", "image", "regions"],
+    }
+    # fields taken from the first target, in the configured order, listing a release
+    release_fields = ("video_id", "title", "start_time", "genre", "collection", "country", "image")
+    # change -> columns the stored rows are matched by, instead of the unique key of the row
+    update_match = {"regions": ["video_id"], "merged": ["video_id"]}
+    # (country, language) crawled when extra_config has no targets
+    default_targets = [{"country": "HK", "language": "zh_cn"}]
+    # guards self.results and self.index while targets are crawled concurrently
+    _merge_lock = threading.Lock()
+
     def __init__(self, _config):
         super().__init__(_config)
-        self.result_hash = set()
-        # these two list are used for deduplication
-        self.notification_list = []
-        self.db_list = []
+        self.targets = [
+            {"country": target.get("country", "HK"), "language": target.get("language", "zh_cn")}
+            for target in self.config.extra_config.get("targets") or self.default_targets
+        ]
 
-    def get_details(self, page=1) -> dict:
+    def get_details(self, page=1, target: Optional[dict] = None) -> dict:
         session = self.get_session()
-        url = f"https://about.netflix.com/api/data/releases?language=zh_cn&page={page}&country=HK"
+        target = target or self.targets[0]
+        base_url = self.config.extra_config.get("base_url", "https://about.netflix.com").rstrip("/")
+        url = f"{base_url}/api/data/releases?language={target['language']}&page={page}&country={target['country']}"
+        service = self.__class__.__name__
         try:
-            res = session.get(url)
-            data = res.json()
+            with metrics.timer("fetch", service=service):
+                res = session.get(url)
+            metrics.inc("sum_pages_fetched_total", service=service)
+            metrics.inc("sum_bytes_fetched_total", len(res.content), service=service)
+            last = _page_digests.get(url)
+            if res.digest and last and last[0] == res.digest:
+                # page has not changed since it was last processed, skip decoding and processing
+                return {'data': [], 'totalPages': last[1]}
+            with metrics.timer("decode", service=service):
+                data = res.json()
+            if res.digest:
+                _page_digests[url] = (res.digest, data.get('totalPages', 1))
             return data
         except RequestException as e:
             logger.error(f"Failed to get data from {url}: {e}")
@@ -29,114 +131,344 @@ class Netflix(Service):
             logger.error(f"Failed to decode json from {url}")
             return {}
 
-    def get_all_details(self) -> dict:
-        page = 1
-        while True:
-            details = self.get_details(page)
-            if not details or 'data' not in details:
-                break
-            for detail in details.get('data', []):
-                name = f"{detail.get('title1', '')} {detail.get('title2', '')}"
-                if name in self.result_hash:
-                    continue
-                self.result_hash.add(name)
-                for _n in self.notification_list:
-                    detail[f'msg_{_n}_read'] = False
-                for _db in self.db_list:
-                    detail[f'sql_{_db}_read'] = False
-                self.results.append(detail)
-            # self.results.extend(details.get('data', []))
-            if page >= details.get('totalPages', 1):
-                break
-            page += 1
-        return {'totalItems': len(self.results), 'items': self.results}
+    @staticmethod
+    def get_key(item: dict) -> str:
+        video_id = item.get('videoID')
+        if not video_id:
+            return f"{item.get('title1', '')} {item.get('title2', '')}"
+        # the same title in another region is the same release, its region is merged in
+        return str(video_id)
+
+    @staticmethod
+    def to_release(key: str, item: dict, region: str = "") -> Release:
+        title1 = item.get('title1', '')
+        title2 = item.get('title2', '')
+        start_time = item.get('startTime', 0)
+        return Release(
+            key=key,
+            video_id=item.get('videoID', 0),
+            title=f"{title1} {title2}" if title1 != title2 else title1,
+            start_time=datetime.fromtimestamp(start_time / 1000 if start_time >= 10 ** 12 else start_time),
+            genre=item.get('genre', 0),
+            collection=item.get('collection', 0),
+            country=item.get('country', ''),
+            image=item.get('image', ''),
+            regions=[region] if region else [],
+        )
+
+    @staticmethod
+    def fingerprint(item: dict) -> str:
+        """
+        Content fingerprint of an item, "startTime:digest of the other fields", so a change of the start time
+        can be told apart from other changes without keeping the fields
+        :param item:
+        :return:
+        """
+        fields = [item.get(field) for field in ('title1', 'title2', 'image', 'genre', 'collection', 'country')]
+        digest = hashlib.blake2b(json.dumps(fields).encode(), digest_size=8).hexdigest()
+        return f"{item.get('startTime', 0)}:{digest}"
+
+    @staticmethod
+    def compare(previous: str, current: str) -> Optional[str]:
+        """
+        :param previous: fingerprint
+        :param current: fingerprint
+        :return: None if nothing changed, else rescheduled or updated
+        """
+        if previous == current:
+            return None
+        return "rescheduled" if previous.partition(":")[2] == current.partition(":")[2] else "updated"
+
+    def _add_details(self, details: dict, target: dict, added: dict[str, Added]) -> int:
+        """
+        Add new and changed items of a page to self.results, and the region to items this crawl already added
+        :param details:
+        :param target: (country, language) the page was crawled for
+        :param added: key -> release added by this crawl
+        :return: number of new and changed items and merged regions
+        """
+        service = self.__class__.__name__
+        region = target["country"]
+        # targets are crawled concurrently, a release takes its fields from the first target listing it
+        rank = self.targets.index(target)
+        # titles and images differ per language, so fingerprints are kept per country/language
+        slot = f"{region}/{target['language']}"
+        data = details.get('data', [])
+        with metrics.timer("dedup", service=service), self._merge_lock:
+            keys = [self.get_key(detail) for detail in data]
+            # releases remembered before regions were merged are keyed by videoID:country
+            legacy_keys = [f"{key}:{detail.get('country', '')}" for key, detail in zip(keys, data)]
+            known = self.index.fingerprints(keys + legacy_keys)
+            # key -> fingerprints per country/language, written back for new keys and changed fingerprints only
+            updates: dict[str, dict[str, str]] = {}
+            counts = {"new": 0, "rescheduled": 0, "updated": 0, "regions": 0, "merged": 0}
+            for key, legacy_key, detail in zip(keys, legacy_keys, data):
+                fingerprints = updates.get(key) or self.parse_fingerprints(known.get(key, ""))
+                fingerprint = self.fingerprint(detail)
+                if key in added:
+                    if region not in added[key].regions or rank < added[key].rank:
+                        self._merge(key, detail, region, rank, added[key])
+                        counts["merged"] += 1
+                elif key in known or legacy_key in known:
+                    # regions may list a title with different start times, so every target is compared to itself.
+                    # a target seen without a fingerprint, e.g. by an older version, is only remembered
+                    change = self.compare(fingerprints[slot], fingerprint) if slot in fingerprints else None
+                    # countries of the stored row, unknown for releases remembered without fingerprints
+                    regions = list(dict.fromkeys(slot.partition("/")[0] for slot in fingerprints))
+                    if change:
+                        release = self.to_release(key, detail, region)
+                        release.change = change
+                        # the stored row keeps the regions it was found in before
+                        release.regions = regions + [region] if region not in regions else regions
+                        # the fields are the ones of the target that changed
+                        self._add_release(release, added, -1)
+                        counts[change] += 1
+                    elif regions and region not in regions and detail.get('videoID'):
+                        # found in another region, the stored rows get the regions but nothing is sent
+                        release = self.to_release(key, detail, region)
+                        release.change = "regions"
+                        release.regions = regions + [region]
+                        self._add_release(release, added, rank)
+                        counts["regions"] += 1
+                else:
+                    self._add_release(self.to_release(key, detail, region), added, rank)
+                    counts["new"] += 1
+                if fingerprints.get(slot) != fingerprint:
+                    # fingerprints of older versions were kept per country only
+                    fingerprints.pop(region, None)
+                    fingerprints[slot] = fingerprint
+                    updates[key] = fingerprints
+            if updates:
+                self.index.update({
+                    key: ";".join(f"{slot}={fingerprint}" for slot, fingerprint in fingerprints.items())
+                    for key, fingerprints in updates.items()
+                })
+        for state, count in counts.items():
+            metrics.inc("sum_items_total", count, service=service, state=state)
+        found = sum(counts.values())
+        metrics.inc("sum_items_total", len(data) - found, service=service, state="seen")
+        return found
+
+    def _add_release(self, release: Release, added: dict[str, Added], rank: int):
+        # only the position and the regions are kept for the rest of the crawl, so a delivered release
+        # can be evicted while later targets still merge into it
+        release.regions = self._ordered(release.regions)
+        added[release.key] = Added(self.results.append(release), release.regions, rank)
+
+    def _merge(self, key: str, detail: dict, region: str, rank: int, entry: Added):
+        """
+        Merge a region into a release of this crawl, a target listed before the one the release came from
+        replaces its fields, so they don't depend on the target finishing first.
+        A release a sink consumed already, e.g. in streaming mode, isn't changed, a regions or merged release
+        updates its stored rows instead
+        :param key:
+        :param detail:
+        :param region:
+        :param rank: index of the target
+        :param entry:
+        :return:
+        """
+        entry.regions = self._ordered(entry.regions + [region])
+        source = self.to_release(key, detail, region) if rank < entry.rank else None
+        if source:
+            entry.rank = rank
+
+        def merge(release: Release):
+            release.regions = entry.regions
+            if source:
+                for field in self.release_fields:
+                    setattr(release, field, getattr(source, field))
+                if release.change == "regions":
+                    release.change = "merged"
+
+        if self.results.modify(entry.position, merge) or not detail.get('videoID'):
+            # rows are matched by video_id, releases keyed by title can't be updated
+            return
+        release = self.to_release(key, detail, region)
+        release.change = "merged" if source else "regions"
+        release.regions = entry.regions
+        entry.position = self.results.append(release)
+
+    def _ordered(self, regions: list[str]) -> list[str]:
+        # configured order of the targets, stored regions may hold countries that are not crawled anymore
+        order = {target["country"]: i for i, target in enumerate(self.targets)}
+        return sorted(dict.fromkeys(regions), key=lambda region: order.get(region, len(order)))
+
+    @staticmethod
+    def parse_fingerprints(value: str) -> dict[str, str]:
+        """
+        :param value: fingerprints per target as stored in the index, "country/language=fingerprint;..."
+        :return: country/language -> fingerprint
+        """
+        return dict(part.split("=", 1) for part in value.split(";") if "=" in part)
+
+    def need_full_crawl(self) -> bool:
+        last_full_crawl = _last_full_crawl.get(self.__class__.__name__)
+        if not self.config.incremental or last_full_crawl is None:
+            return True
+        return datetime.now() - last_full_crawl >= timedelta(minutes=self.config.full_interval)
+
+    @metrics.timed("crawl")
+    def get_all_details(self, on_page: Optional[Callable[[int], None]] = None,
+                        stop: Optional[threading.Event] = None) -> dict:
+        """
+        Crawl every target
+        :param on_page: called with the number of added releases after every page that added some
+        :param stop: set to end the crawl early, the pages being fetched are still processed
+        :return:
+        """
+        full_crawl = self.need_full_crawl()
+        added: dict[str, Added] = {}
+        # targets are crawled concurrently, each one fetches up to concurrency pages in parallel
+        with ThreadPoolExecutor(max_workers=len(self.targets)) as executor:
+            completed = list(executor.map(lambda target: self.crawl_target(target, full_crawl, added, on_page, stop),
+                                          self.targets))
+        if full_crawl and all(completed):
+            _last_full_crawl[self.__class__.__name__] = datetime.now()
+        return {'totalItems': len(self.results), 'items': list(self.results)}
+
+    def crawl_target(self, target: dict, full_crawl: bool, added: dict[str, Added],
+                     on_page: Optional[Callable[[int], None]] = None, stop: Optional[threading.Event] = None) -> bool:
+        """
+        Crawl the pages of one (country, language) target
+        :param target:
+        :param full_crawl: crawl every page even if a page has no new items
+        :param added: key -> release added by this crawl, shared by the targets
+        :param on_page: see get_all_details
+        :param stop: see get_all_details
+        :return: whether every page was crawled
+        """
+        region = target["country"]
+
+        def add(page_details: dict) -> int:
+            count = self._add_details(page_details, target, added)
+            if count and on_page:
+                on_page(count)
+            return count
+
+        # page 1 tells us how many pages there are, the rest can be fetched in parallel
+        details = self.get_details(1, target)
+        if not details or 'data' not in details:
+            return False
+        crawling = add(details) > 0 or full_crawl
+        total_pages = details.get('totalPages', 1)
+        page = 2
+        with ThreadPoolExecutor(max_workers=self.config.concurrency) as executor:
+            while crawling and page <= total_pages:
+                if stop and stop.is_set():
+                    logger.info(f"{self.__class__.__name__} {region} crawl stopped at page {page}")
+                    crawling = False
+                    break
+                window = range(page, min(page + self.config.concurrency, total_pages + 1))
+                # map yields in page order, so deduplication behaves as in a sequential crawl
+                for _page, details in zip(window, executor.map(partial(self.get_details, target=target), window)):
+                    if not details or 'data' not in details:
+                        crawling = False
+                        break
+                    if add(details) == 0 and not full_crawl:
+                        logger.info(f"{self.__class__.__name__} {region} page {_page} has no new items, stop crawling")
+                        crawling = False
+                        break
+                page = window.stop
+        return crawling
 
     def request(self, *args, **kwargs):
-        self.notification_list = kwargs.get("notification_list", [])
-        self.db_list = kwargs.get("db_list", [])
+        evicted = self.results.evict()
+        if evicted:
+            logger.debug(f"{self.__class__.__name__} evicted {evicted} delivered releases")
         self.get_all_details()
 
+    def iter_request(self, *args, **kwargs) -> Iterator[int]:
+        """
+        Crawl in a background thread, yielding after every page that added releases.
+        The crawl waits while a page is not consumed yet, so a slow consumer slows the crawl down.
+        A release found in more regions after it was consumed is followed by a regions release updating its rows.
+        Once the consumer stops, e.g. on an error, the crawl is stopped and waited for when the generator closes.
+        :return: number of releases added by the page
+        """
+        self.results.evict()
+        pages: queue.Queue = queue.Queue(maxsize=1)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            # once the consumer went away, e.g. on an error, the crawl finishes without waiting for it
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def crawl():
+            try:
+                self.get_all_details(on_page=put, stop=stopped)
+            except Exception as e:
+                logger.error(f"{self.__class__.__name__} crawl failed: {e!r}")
+            finally:
+                put(done)
+
+        crawler = threading.Thread(target=crawl, name=f"{self.__class__.__name__}-crawl", daemon=True)
+        crawler.start()
+        try:
+            while (count := pages.get()) is not done:
+                yield count
+        finally:
+            stopped.set()
+            # the crawl must not outlive the run, the next run of the service would overlap it
+            crawler.join()
+
     def deduplication(self, *args, **kwargs):
         ...
 
+    def get_fields(self, record: Release) -> dict:
+        return {
+            **super().get_fields(record),
+            "video_id": record.video_id,
+            "image": record.image,
+            "collection_id": record.collection,
+            "genre_id": record.genre,
+            "country": record.country,
+            "regions": ", ".join(record.regions),
+            "url": f"https://www.netflix.com/watch/{record.video_id}",
+        }
+
+    @metrics.timed("render")
     def get_notification_msgs(self, *args, **kwargs) -> list[NotificationMSG]:
-        msgs = []
         msg_format = kwargs.get("msg_format", "text")
         notification_obj = kwargs.get("notification_obj")
-        for result in self.results:
-            if result.get(f'msg_{hash(notification_obj.__class__.__name__)}_read', False):
-                continue
-            result[f'msg_{hash(notification_obj.__class__.__name__)}_read'] = True
-            title1 = result.get('title1', '')
-            title2 = result.get('title2', '')
-            title_name = f"{title1} {title2}" if title1 != title2 else title1
-            video_id = result.get('videoID', 0)
-            country = result.get('country', '')
-            start_time = result.get('startTime', 0)
-            collection_id = result.get('collection', 0)
-            image = result.get('image', '')
-            genre_id = result.get('genre', 0)
-            start_time_datetime = datetime.fromtimestamp(start_time/1000 if len(str(start_time)) == 13 else start_time)
-            start_time_str = start_time_datetime.strftime(r'%Y-%m-%d %H:%M')
-            msg_title = f"{self.__class__.__name__} New Release"
-            if msg_format == "markdown":
-                msg_body = (f"*Release Name:* {title_name}\n"
-                            f"*video_id:* {video_id}\n"
-                            f"*start_time:* {start_time_str}\n"
-                            f"*image:* [Image]({image})\n"
-                            f"*collection_id:* {collection_id}\n"
-                            f"*genre_id:* {genre_id}\n"
-                            f"*country:* {country}\n"
-                            f"*url:* https://www.netflix.com/watch/{video_id}")
-            elif msg_format == "html":
-                msg_body = (f"<b>Release Name:</b> {title_name}<br>"
-                            f"<b>video_id:</b> {video_id}<br>"
-                            f"<b>start_time:</b> {start_time_str}<br>"
-                            f"<b>image:</b> <a href='{image}'>Image</a><br>"
-                            f"<b>collection_id:</b> {collection_id}<br>"
-                            f"<b>genre_id:</b> {genre_id}<br>"
-                            f"<b>country:</b> {country}<br>"
-                            f"<b>url:</b> https://www.netflix.com/watch/{video_id}")
-            else:
-                msg_body = (f"Release Name: {title_name}\n"
-                            f"video_id: {video_id}\n"
-                            f"start_time: {start_time_str}\n"
-                            f"image: {image}\n"
-                            f"collection_id: {collection_id}\n"
-                            f"genre_id: {genre_id}\n"
-                            f"country: {country}\n"
-                            f"url: https://www.netflix.com/watch/{video_id}")
-            msgs.append(NotificationMSG(title=msg_title, body=msg_body, msg_format=msg_format, name=title_name,
-                                        send_time=start_time_datetime))
-        return msgs
-
-    def get_sql_query(self, session: Session, /, *args, **kwargs) -> list[NetflixSQL]:
-        queries = []
+        # changes without an event, e.g. regions, are only stored
+        return [self.render(result, msg_format) for result in self.pending(notification_obj.name)
+                if result.change in self.events]
+
+    @metrics.timed("sql_rows")
+    def get_sql_rows(self, sink: str, /, *args, **kwargs) -> list[dict]:
+        return [
+            {
+                "name": result.title,
+                "video_id": result.video_id,
+                "country": result.country,
+                "regions": ",".join(result.regions),
+                "release_time": result.start_time,
+                "collection": result.collection,
+                "genre": result.genre,
+                "image": result.image,
+                "url": f"https://www.netflix.com/watch/{result.video_id}",
+                # a stored row of a known release only gets the changed columns, see sql.get_upsert_queries
+                **({"_update": self.update_columns[result.change]} if result.change in self.update_columns else {}),
+                **({"_match": self.update_match[result.change]} if result.change in self.update_match else {}),
+            }
+            for result in self.pending(sink)
+        ]
+
+    def get_sql_query(self, session: "Session", /, *args, **kwargs) -> list:
         if not session:
             logger.error("No session provided")
-            return queries
-        for result in self.results:
-            if result.get(f'sql_{hash(session.bind.url)}_read', False):
-                continue
-            result[f'sql_{hash(session.bind.url)}_read'] = True
-            title1 = result.get('title1', '')
-            title2 = result.get('title2', '')
-            title_name = f"{title1} {title2}" if title1 != title2 else title1
-            # check title_name in db
-            if session.query(NetflixSQL).filter(NetflixSQL.name).first():
-                continue
-            video_id = result.get('videoID', 0)
-            country = result.get('country', '')
-            start_time = result.get('startTime', 0)
-            collection_id = result.get('collection', 0)
-            image = result.get('image', '')
-            genre_id = result.get('genre', 0)
-            url = f"https://www.netflix.com/watch/{video_id}"
-            start_time_datetime = datetime.fromtimestamp(start_time/1000 if len(str(start_time)) == 13 else start_time)
-            query = NetflixSQL(name=title_name, video_id=video_id, country=country, release_time=start_time_datetime,
-                               collection=collection_id, genre=genre_id, image=image, url=url)
-            queries.append(query)
-        return queries
+            return []
+        from utils import sql
+        rows = self.get_sql_rows(f"sql_{session.bind.url}")
+        with metrics.timer("sql_query", service=self.__class__.__name__):
+            return sql.get_upsert_queries(session, self.sql_model, rows)
 
 
 if __name__ == '__main__':
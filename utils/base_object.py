@@ -1,13 +1,21 @@
 import requests
+import threading
 from loguru import logger
-from typing import Optional
 from datetime import datetime
 from utils.config import config
-from utils.sql import ServiceBase
+from utils.metrics import metrics
+from utils.dedup import get_index
+from utils.template import Renderer
 from abc import ABC, abstractmethod
 from pydantic import BaseModel, Field
-from requests.adapters import HTTPAdapter, Retry
+from utils.store import Release, ReleaseStore
 from utils.config import Service as ServiceConfig
+from typing import Iterator, Optional, TYPE_CHECKING
+from utils.http import ServiceAdapter, ResponseCache
+
+if TYPE_CHECKING:
+    # sqlalchemy is only imported when a database is enabled
+    from utils.sql import ServiceBase
 
 
 class DB(ABC):
@@ -27,6 +35,20 @@ class DB(ABC):
 class Notification(ABC):
     def __init__(self, notification_config: dict):
         self.config = notification_config
+        # unique sink name, used to track which releases were delivered
+        self.name = self.__class__.__name__
+        # delivery counters
+        self.sent = 0
+        self.failed = 0
+        self._count_lock = threading.Lock()
+
+    def count(self, success: bool, n: int = 1):
+        with self._count_lock:
+            if success:
+                self.sent += n
+            else:
+                self.failed += n
+        metrics.inc("sum_notifications_total", n, sink=self.name, result="ok" if success else "failed")
 
     @abstractmethod
     def configuration(self, *args, **kwargs):
@@ -36,6 +58,15 @@ class Notification(ABC):
     async def send_msg(self, *args, **kwargs):
         ...
 
+    def send_batch(self, msgs: list["NotificationMSG"], *args, **kwargs) -> bool:
+        """
+        Send messages due at the same time, one by one unless the notification can do better.
+        :param msgs:
+        :return: whether every message was sent
+        """
+        results = [self.send_msg(msg) for msg in msgs]
+        return all(results)
+
 
 class NotificationMSG(BaseModel):
     send_time: datetime = Field(default_factory=datetime.now, description="Notification send time")
@@ -47,45 +78,142 @@ class NotificationMSG(BaseModel):
 
 
 class Service(ABC):
-    _session = None
+    _adapter: Optional[ServiceAdapter] = None
+    _adapter_lock = threading.Lock()
+    _local = threading.local()
+    # msg_format -> {"title": ..., "body": ...}, see utils.template.Renderer
+    templates: dict[str, dict[str, str]] = {}
+    # Release.change -> $event of the message templates, other changes only update the stored rows
+    events = {"new": "New Release", "rescheduled": "Release Rescheduled", "updated": "Release Updated"}
+    # table the results are stored in
+    sql_model: type["ServiceBase"] = None
 
     def __init__(self, _config):
         # is this necessary?
         # self.log = logger.bind(self.ALIASED[0])
-        self.results = []
         self.config: ServiceConfig = _config
+        self.results = ReleaseStore(retention=self.config.retention)
+        self.renderer = Renderer(self.templates, self.config.templates)
+        # releases seen so far, keyed by Service.get_key
+        self.index = get_index(self.__class__.__name__.lower())
 
     @staticmethod
-    def get_session() -> requests.Session:
+    def get_adapter() -> ServiceAdapter:
         """
-        Create a new session and add headers from config.
+        Create the adapter shared by every session, its connection pool is thread safe.
         :return:
         """
-        if Service._session is None:
-            Service._session = requests.Session()
-            Service._session.mount("https://", HTTPAdapter(
-                max_retries=Retry(
-                    total=5,
-                    backoff_factor=1,
-                    status_forcelist=[429, 500, 502, 503, 504],
+        with Service._adapter_lock:
+            if Service._adapter is None:
+                http = config.http
+                cache = None
+                if http.cache.enable:
+                    cache = ResponseCache(http.cache.cache_dir, http.cache.max_size * 1024 * 1024)
+                # enough connections for the pages fetched in parallel, pool_block makes extra threads wait
+                pool_maxsize = http.pool_maxsize or max(
+                    sum(s.concurrency for s in config.services.values() if s.enable), 10
+                )
+                Service._adapter = ServiceAdapter(
+                    cache=cache,
+                    retries=http.retries,
+                    backoff_factor=http.backoff_factor,
+                    max_backoff=http.max_backoff,
+                    rate_limit=(http.rate_limit.rate, http.rate_limit.burst) if http.rate_limit.enable else None,
+                    circuit_breaker=(http.circuit_breaker.failure_threshold, http.circuit_breaker.reset_timeout)
+                    if http.circuit_breaker.enable else None,
+                    pool_maxsize=pool_maxsize,
+                    pool_block=True,
                 )
-            ))
-            Service._session.hooks = {
+        return Service._adapter
+
+    @staticmethod
+    def get_session() -> requests.Session:
+        """
+        Get the session of the current thread and add headers from config.
+        Sessions are not thread safe, so every thread gets one, sharing the adapter and its connection pool.
+        :return:
+        """
+        session = getattr(Service._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = Service.get_adapter()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.hooks = {
                 "response": lambda r, *_, **__: r.raise_for_status(),
             }
-            Service._session.headers.update(config.headers)
-        return Service._session
+            session.headers.update(config.headers)
+            Service._local.session = session
+        return session
+
+    def pending(self, sink: str) -> list[Release]:
+        """
+        Get the results a sink has not consumed yet.
+        :param sink: sink name
+        :return:
+        """
+        return self.results.pending(sink)
+
+    def render(self, record: Release, msg_format: str) -> NotificationMSG:
+        """
+        Render a release once per format, the message is reused by every sink using that format.
+        :param record:
+        :param msg_format:
+        :return:
+        """
+        if record.rendered is None:
+            record.rendered = {}
+        if msg_format not in record.rendered:
+            title, body = self.renderer.render(self.get_fields(record), msg_format)
+            # the name is the scheduling key of the message, titles are not unique but release keys are
+            record.rendered[msg_format] = NotificationMSG(title=title, body=body, msg_format=msg_format,
+                                                          name=f"{self.__class__.__name__}:{record.key}",
+                                                          send_time=record.start_time)
+        return record.rendered[msg_format]
+
+    def get_fields(self, record: Release) -> dict:
+        """
+        Placeholder values of the message templates.
+        :param record:
+        :return:
+        """
+        return {
+            "service": self.__class__.__name__,
+            "change": record.change,
+            "event": self.events.get(record.change, record.change),
+            "name": record.title,
+            "start_time": record.start_time.strftime(r'%Y-%m-%d %H:%M'),
+        }
+
+    @staticmethod
+    def get_key(item: dict) -> str:
+        """
+        Stable identifier of a release, used for deduplication.
+        :param item:
+        :return:
+        """
+        raise NotImplementedError
 
     @abstractmethod
     def request(self, *args, **kwargs):
         """
-        Make a request to the service and save to self.results for further processing.
+        Make a request to the service and save Release records to self.results for further processing.
         :param args:
         :param kwargs:
         :return:
         """
         raise NotImplementedError
 
+    def iter_request(self, *args, **kwargs) -> Iterator[int]:
+        """
+        Make a request like self.request, yielding whenever releases were added so they can be delivered
+        while the request goes on. Services that can't stream yield once, after the whole request.
+        :return: number of releases added since the last yield
+        """
+        position = self.results.total
+        self.request(*args, **kwargs)
+        yield self.results.total - position
+
     @abstractmethod
     def deduplication(self, *args, **kwargs):
         """
@@ -99,5 +227,19 @@ class Service(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def get_sql_query(self, session, /, *args, **kwargs) -> list[ServiceBase]:
+    def get_sql_rows(self, sink: str, /, *args, **kwargs) -> list[dict]:
+        """
+        Convert the results a database has not stored yet to rows of self.sql_model.
+        :param sink: sink name of the database
+        :return:
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_sql_query(self, session, /, *args, **kwargs) -> list:
+        """
+        Build the statements that store new results in the database of the session.
+        :param session:
+        :return:
+        """
         raise NotImplementedError
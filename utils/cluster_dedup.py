@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+from loguru import logger
+from typing import Iterable
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import Engine, String, Text, exists, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+# rows per statement, like the sqlite index
+_CHUNK = 500
+
+
+class DedupBase(DeclarativeBase):
+    pass
+
+
+class SeenSQL(DedupBase):
+    __tablename__ = 'sum_seen'
+    namespace: Mapped[str] = mapped_column(String(64), primary_key=True, comment="service name")
+    key: Mapped[str] = mapped_column(String(255), primary_key=True, comment="release key, see Service.get_key")
+    fingerprint: Mapped[str] = mapped_column(Text, nullable=True, comment="content fingerprint of the release")
+
+    def __repr__(self):
+        return f"Seen({self.namespace!r}:{self.key!r})"
+
+
+class ClusterDedupIndex:
+    """
+    Dedup index kept in the database shared by the nodes of a cluster, so a release seen by one node
+    is known to every node. Same interface as utils.dedup.DedupIndex.
+    Keys seen by this node before the cluster was enabled are copied from the local index on first use.
+    """
+
+    def __init__(self, namespace: str, local_path: str = ""):
+        """
+        :param namespace:
+        :param local_path: sqlite index of this node, imported while the shared one has no key of the namespace
+        """
+        self.namespace = namespace
+        self.local_path = local_path
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # services are pickled into the scheduler job store, the engine is looked up again on demand
+        return {"namespace": self.namespace, "local_path": self.local_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["namespace"], state["local_path"])
+
+    @property
+    def engine(self) -> Engine:
+        with self._lock:
+            if self._engine is None:
+                from utils.lease import get_leases
+                engine = get_leases().engine
+                DedupBase.metadata.create_all(engine)
+                self._import_local(engine)
+                self._engine = engine
+            return self._engine
+
+    def fingerprints(self, keys: Iterable[str]) -> dict[str, str]:
+        """
+        Look up keys and their fingerprints in the index
+        :param keys:
+        :return: key -> fingerprint of the keys already seen, "" for keys seen without a fingerprint
+        """
+        keys = list(keys)
+        known = {}
+        with self.engine.connect() as conn:
+            for i in range(0, len(keys), _CHUNK):
+                rows = conn.execute(select(SeenSQL.key, SeenSQL.fingerprint).where(
+                    SeenSQL.namespace == self.namespace, SeenSQL.key.in_(keys[i:i + _CHUNK])
+                ))
+                known.update((key, fingerprint or "") for key, fingerprint in rows)
+        return known
+
+    def update(self, fingerprints: dict[str, str]):
+        """
+        Add keys or replace their fingerprints
+        :param fingerprints: key -> fingerprint
+        :return:
+        """
+        self._update(self.engine, fingerprints)
+
+    def _update(self, engine: Engine, fingerprints: dict[str, str]):
+        from utils.sql import upsert
+        rows = [{"namespace": self.namespace, "key": key, "fingerprint": fingerprint}
+                for key, fingerprint in fingerprints.items()]
+        with engine.begin() as conn:
+            for i in range(0, len(rows), _CHUNK):
+                conn.execute(upsert(engine.dialect.name, SeenSQL, rows[i:i + _CHUNK], ("namespace", "key")))
+
+    def _import_local(self, engine: Engine):
+        """
+        Copy the keys of the local index, so enabling the cluster doesn't send every known release again
+        :param engine:
+        :return:
+        """
+        if not self.local_path or not os.path.exists(self.local_path):
+            return
+        with engine.connect() as conn:
+            if conn.execute(select(exists().where(SeenSQL.namespace == self.namespace))).scalar():
+                return
+        try:
+            local = sqlite3.connect(self.local_path)
+            try:
+                rows = dict(local.execute("SELECT key, fingerprint FROM seen WHERE namespace = ?", [self.namespace]))
+            finally:
+                local.close()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read the local dedup index {self.local_path}: {e}")
+            return
+        if not rows:
+            return
+        try:
+            self._update(engine, rows)
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to copy the local dedup index to the cluster database: {e}")
+            return
+        logger.info(f"Copied {len(rows)} {self.namespace} keys of {self.local_path} to the cluster database")
@@ -5,7 +5,7 @@ import traceback
 from pathlib import Path
 from loguru import logger
 from typing import Optional, Union
-from pydantic import BaseModel, Field, ValidationError, field_serializer
+from pydantic import BaseModel, Field, ValidationError, field_serializer, field_validator
 
 
 class Directories:
@@ -13,6 +13,8 @@ class Directories:
         self.package_root = Path(__file__).resolve().parent.parent
         self.configuration = self.package_root / "config"
         self.logs = self.package_root / "logs"
+        self.cache = self.package_root / "cache"
+        self.spill = self.package_root / "spill"
 
 
 d = Directories()
@@ -24,10 +26,18 @@ class DBConfig(BaseModel):
     db: str = Field(default="", description="Database name")
     user: str = Field(default="", description="Database user")
     password: str = Field(default="", description="Database password")
+    pool_size: int = Field(default=5, description="Connections kept in the pool")
+    max_overflow: int = Field(default=10, description="Connections opened beyond pool_size under load")
+    pool_pre_ping: bool = Field(default=True, description="Test connections before use, drops ones closed by server")
+    pool_recycle: int = Field(default=3600, description="Seconds after which a connection is replaced, -1 to disable")
 
 
 class SQLiteConfig(BaseModel):
     db_path: str = Field(default=f"{d.configuration}/sqlite.db", description="SQLite file abs path")
+    journal_mode: str = Field(default="WAL", description="SQLite journal mode, WAL lets readers and a writer overlap")
+    synchronous: str = Field(default="NORMAL", description="SQLite synchronous mode")
+    cache_size: int = Field(default=-16000, description="SQLite page cache, negative values are in KiB")
+    mmap_size: int = Field(default=134217728, description="SQLite memory-mapped I/O size, in bytes")
 
     @field_serializer('db_path')
     def no_args(self, v):
@@ -40,11 +50,18 @@ class DB(BaseModel):
     enable: bool = Field(default=False, description="Enable database")
     type: str = Field(default="sqlite", description="Database type")
     config: Union[DBConfig, SQLiteConfig] = Field(default_factory=dict, description="Database extra configuration")
+    queue_size: int = Field(default=10000, description="Max rows waiting to be written, overflow is spilled to disk")
+    batch_size: int = Field(default=500, description="Max rows written in one commit")
+    flush_interval: float = Field(default=5, description="Max seconds rows wait before being committed")
+    put_timeout: float = Field(default=60, ge=0,
+                               description="Seconds a streaming run waits for room in the queue before spilling")
+    max_retries: int = Field(default=5, description="Write attempts before a batch is spilled to disk")
 
 
 class Notification(BaseModel):
     enable: bool = Field(default=False, description="Enable notifications")
     type: str = Field(default="", description="Notification type")
+    name: str = Field(default="", description="Unique notification name, defaults to <type>_<index>")
     config: dict = Field(default_factory=dict, description="Notification extra configuration")
 
 
@@ -59,19 +76,111 @@ class Scheduler(BaseModel):
     store: list[SchedulerStore] = Field(default_factory=list, description="Scheduler store configuration")
 
 
+class Outbox(BaseModel):
+    enable: bool = Field(default=True, description="Keep notifications in an outbox table of the first database")
+    batch_size: int = Field(default=100, gt=0, description="Max messages claimed at once")
+    max_attempts: int = Field(default=8, gt=0, description="Delivery attempts before a message is dead")
+    backoff: float = Field(default=30, ge=0, description="Seconds before the first retry, doubled for every retry")
+    max_backoff: float = Field(default=3600, ge=0, description="Max seconds between two attempts")
+    claim_timeout: float = Field(default=300, gt=0,
+                                 description="Seconds after which a claimed message that was not delivered is retried")
+    retention: float = Field(default=168, ge=0, description="Hours to keep sent messages")
+
+
+class Cluster(BaseModel):
+    enable: bool = Field(default=False, description="Claim every crawl and notification batch for one node")
+    node: str = Field(default="", description="Unique node name, defaults to <hostname>-<pid>")
+    type: str = Field(default="sqlite", description="Type of the database shared by the nodes")
+    config: Union[DBConfig, SQLiteConfig] = Field(default_factory=SQLiteConfig,
+                                                  description="Shared database extra configuration")
+    ttl: float = Field(default=60, gt=0, description="Seconds a lease lasts without heartbeat")
+    heartbeat: float = Field(default=15, gt=0, description="Seconds between two extensions of the leases in use")
+    linger: float = Field(default=300, ge=0,
+                          description="Seconds a finished crawl or notification batch stays claimed")
+
+
 class Service(BaseModel):
     enable: bool = Field(default=False, description="Enable service update monitoring")
     interval: int = Field(default=60, description="Service update interval, in minutes")
+    streaming: bool = Field(default=False, description="Deliver new releases page by page during the crawl")
+    adaptive: bool = Field(default=False, description="Adapt the interval to the crawls, within the bounds")
+    min_interval: float = Field(default=5, gt=0, description="Shortest adaptive interval, in minutes")
+    max_interval: float = Field(default=1440, gt=0, description="Longest adaptive interval, in minutes")
+    backoff: float = Field(default=2, ge=1, description="Interval factor per crawl without new releases")
     immediate_send: bool = Field(default=False, description="Send notification immediately on update")
+    concurrency: int = Field(default=4, ge=1, description="Max number of pages fetched in parallel")
+    incremental: bool = Field(default=False, description="Stop crawling at the first page without new items")
+    full_interval: int = Field(default=10080, description="Full re-crawl interval in incremental mode, in minutes")
+    retention: int = Field(default=0, description="Minutes to keep releases in memory after every sink consumed them")
+    templates: dict[str, dict[str, str]] = Field(default_factory=dict,
+                                                 description="Message templates per format, {title, body} with $fields")
     extra_config: dict = Field(default_factory=dict, description="Service extra configuration")
 
 
+class HTTPCache(BaseModel):
+    enable: bool = Field(default=False, description="Enable on-disk HTTP response cache")
+    cache_dir: str = Field(default=f"{d.cache}", description="HTTP cache directory abs path")
+    max_size: int = Field(default=64, description="Max size of the HTTP cache, in MB")
+
+    @field_validator('cache_dir')
+    def default_dir(cls, v):
+        if v is None or v == "":
+            return f"{d.cache}"
+        return v
+
+
+class RateLimit(BaseModel):
+    enable: bool = Field(default=True, description="Limit the request rate per host, shared by every service")
+    rate: float = Field(default=5, gt=0, description="Requests per second per host")
+    burst: int = Field(default=10, ge=1, description="Requests a host may get at once after being idle")
+
+
+class CircuitBreaker(BaseModel):
+    enable: bool = Field(default=True, description="Fail requests fast while a host keeps failing")
+    failure_threshold: int = Field(default=5, ge=1, description="Consecutive failures that open the breaker")
+    reset_timeout: float = Field(default=60, gt=0, description="Seconds before a trial request, once opened")
+
+
+class HTTP(BaseModel):
+    cache: HTTPCache = Field(default_factory=HTTPCache, description="HTTP response cache configuration")
+    retries: int = Field(default=5, ge=0, description="Retries of a request on 429/5xx and connection errors")
+    backoff_factor: float = Field(default=1, ge=0, description="The n-th retry waits backoff_factor * 2^n seconds")
+    max_backoff: float = Field(default=60, ge=0,
+                               description="Longest wait before a retry, a longer Retry-After fails the request")
+    pool_maxsize: int = Field(default=0, ge=0, description="Connections kept per host, 0 to size by concurrency")
+    rate_limit: RateLimit = Field(default_factory=RateLimit, description="Rate limit per host")
+    circuit_breaker: CircuitBreaker = Field(default_factory=CircuitBreaker, description="Circuit breaker per host")
+
+
+class Dedup(BaseModel):
+    enable: bool = Field(default=True, description="Persist seen releases across restarts")
+    db_path: str = Field(default=f"{d.configuration}/dedup.db", description="Deduplication index file abs path")
+
+    @field_validator('db_path')
+    def default_path(cls, v):
+        if v is None or v == "":
+            return f"{d.configuration}/dedup.db"
+        return v
+
+
+class Metrics(BaseModel):
+    enable: bool = Field(default=False, description="Serve Prometheus metrics over HTTP")
+    host: str = Field(default="127.0.0.1", description="Metrics listen address")
+    port: int = Field(default=9108, description="Metrics listen port")
+    textfile: str = Field(default="", description="Write metrics to this file after every run, empty to disable")
+
+
 class Config(BaseModel):
     log: dict = Field(default="info", description="Logging level")
     headers: dict = Field(default_factory=dict, description="Default headers")
+    http: HTTP = Field(default_factory=HTTP, description="HTTP client configuration")
+    dedup: Dedup = Field(default_factory=Dedup, description="Deduplication index configuration")
+    metrics: Metrics = Field(default_factory=Metrics, description="Metrics configuration")
     db: list[DB] = Field(default_factory=list, description="Database configuration")
     notifications: list[Notification] = Field(default_factory=list, description="Notification configuration")
+    outbox: Outbox = Field(default_factory=Outbox, description="Notification outbox configuration")
     scheduler: Scheduler = Field(default_factory=Scheduler, description="Scheduler configuration")
+    cluster: Cluster = Field(default_factory=Cluster, description="Multi-node coordination configuration")
     services: dict[str, Service] = Field(default_factory=dict, description="Service configuration")
 
     class Config:
@@ -111,7 +220,8 @@ def configure_logger(_config: Config):
 
 
 try:
-    config = load_config(os.path.join(d.configuration, 'config.yaml'))
+    # SUM_CONFIG points to another configuration file, e.g. for the benchmarks
+    config = load_config(os.environ.get("SUM_CONFIG") or os.path.join(d.configuration, 'config.yaml'))
     configure_logger(config)
     logger.info(f"Configuration loaded: {config.model_dump_json()}")
 except ValidationError as e:
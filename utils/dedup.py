@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+from typing import Iterable
+from utils.config import config
+
+# sqlite limits the number of host parameters in one statement
+_CHUNK = 500
+
+
+class DedupIndex:
+    """
+    Persistent set of release keys that have already been seen, stored in a sqlite table.
+    Lookups go through the primary key, so the history is never loaded into memory and survives restarts.
+    Every key can keep a fingerprint of its content, so changes of known releases can be detected.
+    """
+
+    def __init__(self, db_path: str, namespace: str):
+        self.db_path = db_path
+        self.namespace = namespace
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # services are pickled into the scheduler job store, the connection is reopened on demand
+        return {"db_path": self.db_path, "namespace": self.namespace}
+
+    def __setstate__(self, state):
+        self.__init__(state["db_path"], state["namespace"])
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, fingerprint TEXT, PRIMARY KEY (namespace, key)"
+                ") WITHOUT ROWID"
+            )
+            # indexes created by older versions have no fingerprints
+            if "fingerprint" not in {row[1] for row in self._conn.execute("PRAGMA table_info(seen)")}:
+                self._conn.execute("ALTER TABLE seen ADD COLUMN fingerprint TEXT")
+        return self._conn
+
+    def fingerprints(self, keys: Iterable[str]) -> dict[str, str]:
+        """
+        Look up keys and their fingerprints in the index
+        :param keys:
+        :return: key -> fingerprint of the keys already seen, "" for keys seen without a fingerprint
+        """
+        keys = list(keys)
+        known = {}
+        with self._lock:
+            for i in range(0, len(keys), _CHUNK):
+                chunk = keys[i:i + _CHUNK]
+                rows = self.conn.execute(
+                    f"SELECT key, fingerprint FROM seen WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [self.namespace, *chunk],
+                )
+                known.update((key, fingerprint or "") for key, fingerprint in rows)
+        return known
+
+    def update(self, fingerprints: dict[str, str]):
+        """
+        Add keys or replace their fingerprints
+        :param fingerprints: key -> fingerprint
+        :return:
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO seen (namespace, key, fingerprint) VALUES (?, ?, ?)",
+                [(self.namespace, key, fingerprint) for key, fingerprint in fingerprints.items()],
+            )
+            self.conn.commit()
+
+
+def get_index(namespace: str):
+    """
+    Get the dedup index of a service, kept in the cluster database when the cluster is enabled so every node
+    knows what the others have seen, else in the local sqlite file
+    :param namespace: service name
+    :return: DedupIndex or ClusterDedupIndex
+    """
+    if not config.dedup.enable:
+        return DedupIndex(":memory:", namespace)
+    if config.cluster.enable:
+        from utils.cluster_dedup import ClusterDedupIndex
+        return ClusterDedupIndex(namespace, config.dedup.db_path)
+    return DedupIndex(config.dedup.db_path, namespace)
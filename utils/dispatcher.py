@@ -0,0 +1,256 @@
+import os
+import json
+import heapq
+import itertools
+import threading
+from loguru import logger
+from utils.metrics import metrics
+from utils.config import d, config
+from utils.singleflight import claim
+from datetime import datetime, timedelta
+from typing import Optional, TYPE_CHECKING
+from utils.base_object import Notification, NotificationMSG
+
+if TYPE_CHECKING:
+    # sqlalchemy is only imported when a database is enabled
+    from utils.outbox import Outbox
+
+JOB_NAME = "notification_dispatcher"
+
+
+class Dispatcher:
+    """
+    Timer queue of scheduled notifications, ordered by send time.
+    Due messages are sent to each sink in one batch per send time, and a single scheduler job
+    wakes the dispatcher up at the earliest send time. Pending messages are saved to disk.
+    With a database, messages are kept in its outbox table instead, see utils.outbox, the heap only
+    holds messages the outbox failed to take.
+    """
+
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.sinks: dict[str, Notification] = {}
+        # heap of (send_time, seq, sink, name), entries whose seq is not in self.pending anymore are stale
+        self.heap: list[tuple[datetime, int, str, str]] = []
+        # (sink, name) -> (seq, send_time, msg)
+        self.pending: dict[tuple[str, str], tuple[int, datetime, NotificationMSG]] = {}
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+        # run date of the wakeup job
+        self._armed: Optional[datetime] = None
+        self.outbox: Optional["Outbox"] = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def start(self, notifications: list[Notification], outbox: Optional["Outbox"] = None):
+        """
+        Register the sinks, load the messages saved by the previous run and arm the wakeup job.
+        :param notifications:
+        :param outbox: keep the messages in this outbox, messages saved to disk are moved into it
+        :return:
+        """
+        with self._lock:
+            self.sinks = {n.name: n for n in notifications}
+            self.outbox = outbox
+            for sink, send_time, msg in self._load():
+                if sink not in self.sinks:
+                    logger.warning(f"Notification {sink} is not enabled anymore, drop scheduled message {msg.name}")
+                    continue
+                self._push(sink, send_time, msg)
+            if self.outbox:
+                try:
+                    for sink, count in self.outbox.orphans(list(self.sinks)).items():
+                        logger.warning(f"{count} notifications in the outbox wait for {sink}, which is not enabled, "
+                                       f"they are sent once a notification named {sink} is enabled again")
+                except Exception as e:
+                    logger.error(f"Failed to look up the outbox: {e!r}")
+            if self.outbox and self.pending:
+                scheduled: dict[str, list[tuple[NotificationMSG, datetime]]] = {}
+                for (sink, _), (_, send_time, msg) in self.pending.items():
+                    scheduled.setdefault(sink, []).append((msg, send_time))
+                for sink, msgs in scheduled.items():
+                    self.schedule(self.sinks[sink], msgs)
+            self._rearm()
+
+    def schedule(self, notification: Notification, msgs: list[tuple[NotificationMSG, datetime]]):
+        """
+        Schedule messages, a message with the same name for the same sink is rescheduled.
+        :param notification:
+        :param msgs: (message, send time) pairs
+        :return:
+        """
+        if not msgs:
+            return
+        with self._lock:
+            self.sinks.setdefault(notification.name, notification)
+            if self.outbox:
+                try:
+                    self.outbox.append(notification.name, msgs)
+                    # moved into the outbox, a message still on the heap would be sent twice
+                    for msg, _ in msgs:
+                        self.pending.pop((notification.name, msg.name), None)
+                    self._save()
+                    self._rearm()
+                    return
+                except Exception as e:
+                    logger.error(f"Failed to add {len(msgs)} notifications to the outbox, keep them on disk: {e!r}")
+            for msg, send_time in msgs:
+                self._push(notification.name, send_time, msg)
+            self._save()
+            self._rearm()
+
+    def send(self, notification: Notification, msgs: list[NotificationMSG]) -> bool:
+        """
+        Send messages right away. With an outbox they go through it, failed ones are retried later.
+        :param notification:
+        :param msgs:
+        :return: whether every message was sent
+        """
+        if not msgs:
+            return True
+        if self.outbox:
+            try:
+                ids = self.outbox.append(notification.name, [(msg, None) for msg in msgs])
+            except Exception as e:
+                logger.error(f"Failed to add {len(msgs)} notifications to the outbox, send them directly: {e!r}")
+            else:
+                # the drain also sends due retries and scheduled messages, only these ones count
+                success = set(ids) <= set(self.outbox.drain({notification.name: notification}))
+                with self._lock:
+                    # failed messages are retried by the wakeup job
+                    self._rearm()
+                return success
+        if notification.config.get("digest"):
+            # one notification for the messages of the run
+            with metrics.timer("send", sink=notification.name):
+                success = notification.send_batch(msgs)
+            notification.count(success, len(msgs))
+            logger.log("INFO" if success else "ERROR",
+                       f"Send {len(msgs)} notifications to {notification.name} {'success' if success else 'failed'}")
+            return success
+        success = True
+        for msg in msgs:
+            with metrics.timer("send", sink=notification.name):
+                sent = notification.send_msg(msg)
+            notification.count(sent)
+            if sent:
+                logger.info(f"Send notification success")
+            else:
+                success = False
+                logger.error(f"Send notification failed")
+        return success
+
+    def dispatch(self):
+        """
+        Send every due message, grouped per sink and send time.
+        :return:
+        """
+        now = datetime.now()
+        batches: dict[tuple[str, datetime], list[NotificationMSG]] = {}
+        with self._lock:
+            self._armed = None
+            while self.heap and self.heap[0][0] <= now:
+                send_time, seq, sink, name = heapq.heappop(self.heap)
+                entry = self.pending.get((sink, name))
+                if not entry or entry[0] != seq:
+                    continue
+                del self.pending[(sink, name)]
+                batches.setdefault((sink, send_time), []).append(entry[2])
+            self._save()
+        for (sink, send_time), msgs in batches.items():
+            # nodes scheduling the same messages send each batch once
+            with claim(f"notify:{sink}:{send_time.isoformat()}") as claimed:
+                if not claimed:
+                    logger.info(f"{len(msgs)} notifications to {sink} scheduled at {send_time} are sent by another node")
+                    metrics.inc("sum_runs_claimed_elsewhere_total", sink=sink)
+                    continue
+                try:
+                    with metrics.timer("send", sink=sink):
+                        sent = self.sinks[sink].send_batch(msgs)
+                except Exception as e:
+                    logger.error(f"Send notifications to {sink} raised {e!r}")
+                    sent = False
+            self.sinks[sink].count(sent, len(msgs))
+            if sent:
+                logger.info(f"Send {len(msgs)} notifications to {sink} scheduled at {send_time} success")
+            else:
+                logger.error(f"Send {len(msgs)} notifications to {sink} scheduled at {send_time} failed")
+        if self.outbox:
+            try:
+                self.outbox.drain(self.sinks)
+            except Exception as e:
+                logger.error(f"Failed to drain the outbox: {e!r}")
+        with self._lock:
+            self._rearm()
+
+    def _push(self, sink: str, send_time: datetime, msg: NotificationMSG):
+        seq = next(self._seq)
+        self.pending[(sink, msg.name)] = (seq, send_time, msg)
+        heapq.heappush(self.heap, (send_time, seq, sink, msg.name))
+
+    def _rearm(self):
+        # drop stale entries so the head of the heap is the next real send time
+        while self.heap and self.pending.get((self.heap[0][2], self.heap[0][3]), (None,))[0] != self.heap[0][1]:
+            heapq.heappop(self.heap)
+        due = [self.heap[0][0]] if self.heap else []
+        if self.outbox:
+            try:
+                due.extend(filter(None, [self.outbox.next_due(list(self.sinks))]))
+            except Exception as e:
+                logger.error(f"Failed to look up the next notification in the outbox: {e!r}")
+        if not due:
+            self._armed = None
+            return
+        if not config.scheduler.enable:
+            logger.warning(f"Scheduler is disabled, scheduled notifications are sent by the first run after "
+                           f"their send time")
+            return
+        # the scheduler is only imported when it is enabled
+        from utils.scheduler import add_job
+        from apscheduler.triggers.date import DateTrigger
+        # a send time already passed (e.g. while the process was down) is dispatched right away
+        run_date = max(min(due), datetime.now() + timedelta(seconds=1))
+        if self._armed and self._armed == min(due):
+            return
+        add_job(dispatch, DateTrigger(run_date=run_date), name=JOB_NAME)
+        self._armed = min(due)
+
+    def _save(self):
+        metrics.set("sum_scheduled_notifications", len(self.pending))
+        state = [
+            {"sink": sink, "send_time": send_time.isoformat(), "msg": msg.model_dump(mode="json")}
+            for (sink, _), (_, send_time, msg) in self.pending.items()
+        ]
+        try:
+            tmp = f"{self.state_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            logger.error(f"Failed to save scheduled notifications to {self.state_path}: {e}")
+
+    def _load(self) -> list[tuple[str, datetime, NotificationMSG]]:
+        if not os.path.exists(self.state_path):
+            return []
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load scheduled notifications from {self.state_path}: {e}")
+            return []
+        return [
+            (item["sink"], datetime.fromisoformat(item["send_time"]), NotificationMSG(**item["msg"]))
+            for item in state
+        ]
+
+
+dispatcher = Dispatcher(os.path.join(d.configuration, "dispatcher.json"))
+
+
+def dispatch():
+    """
+    Entry point of the wakeup job, a module level function so the job can be kept in a persistent job store.
+    :return:
+    """
+    dispatcher.dispatch()
@@ -0,0 +1,144 @@
+import csv
+import sys
+import json
+from loguru import logger
+from datetime import datetime
+from typing import IO, Iterator, Optional
+from utils.sql import ServiceBase, NetflixSQL
+from sqlalchemy import Engine, DateTime, Integer, and_, inspect, literal, or_, select, tuple_
+
+FORMATS = ("ndjson", "csv", "parquet")
+
+
+def iter_rows(engine: Engine, model: type[ServiceBase] = NetflixSQL, since: Optional[datetime] = None,
+              until: Optional[datetime] = None, region: str = "", video_ids: Optional[list[int]] = None,
+              batch_size: int = 1000) -> Iterator[list[dict]]:
+    """
+    Stream stored rows page by page with keyset pagination, every page is a short query resuming after the
+    last key of the previous one, so neither the database nor this process holds more than a page.
+    With a date range the pages follow the (release_time, id) index, otherwise the primary key.
+    :param engine:
+    :param model:
+    :param since: release_time lower bound, inclusive
+    :param until: release_time upper bound, exclusive
+    :param region: country the release was found in
+    :param video_ids:
+    :param batch_size: rows per page
+    :return: pages of rows
+    """
+    columns = list(model.__table__.columns)
+    by_time = since is not None or until is not None
+    key = (model.release_time, model.id) if by_time else (model.id,)
+    filters = []
+    if since is not None:
+        filters.append(model.release_time >= since)
+    if until is not None:
+        filters.append(model.release_time < until)
+    if video_ids:
+        filters.append(model.video_id.in_(video_ids))
+    if region and hasattr(model, "regions"):
+        # regions is a comma separated list, rows stored before regions were merged only have a country
+        filters.append(or_((literal(",") + model.regions + literal(",")).like(f"%,{region},%"),
+                           and_(model.regions.is_(None), model.country == region)))
+    last = None
+    while True:
+        stmt = select(*columns).where(*filters).order_by(*key).limit(batch_size)
+        if last is not None:
+            stmt = stmt.where(tuple_(*key) > tuple_(*last) if by_time else model.id > last[0])
+        with engine.connect() as conn:
+            # server side cursor where the driver supports one, rows are fetched as they are consumed
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+            page = [dict(row) for row in result.mappings()]
+        if not page:
+            return
+        yield page
+        if len(page) < batch_size:
+            return
+        last = tuple(page[-1][column.key] for column in key)
+
+
+def write_ndjson(pages: Iterator[list[dict]], output: IO) -> int:
+    count = 0
+    for page in pages:
+        for row in page:
+            output.write(json.dumps(row, default=datetime.isoformat, ensure_ascii=False) + "\n")
+        count += len(page)
+    return count
+
+
+def write_csv(pages: Iterator[list[dict]], output: IO, fieldnames: list[str]) -> int:
+    writer = csv.DictWriter(output, fieldnames=fieldnames)
+    writer.writeheader()
+    count = 0
+    for page in pages:
+        writer.writerows(page)
+        count += len(page)
+    return count
+
+
+def write_parquet(pages: Iterator[list[dict]], path: str, model: type[ServiceBase]) -> int:
+    """
+    Write one row group per page
+    :param pages:
+    :param path:
+    :param model:
+    :return: number of rows written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow, install it with: pip install pyarrow")
+    # the schema comes from the model, so pages with only nulls in a column keep the column type
+    schema = pa.schema([
+        (column.name, pa.timestamp("us") if isinstance(column.type, DateTime)
+         else pa.int64() if isinstance(column.type, Integer) else pa.string())
+        for column in model.__table__.columns
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for page in pages:
+            writer.write_table(pa.Table.from_pylist(page, schema=schema))
+            count += len(page)
+    return count
+
+
+def export(engine: Engine, output: str = "-", fmt: str = "ndjson", model: type[ServiceBase] = NetflixSQL,
+           **filters) -> int:
+    """
+    Export stored rows in constant memory
+    :param engine:
+    :param output: file path, - for stdout
+    :param fmt: ndjson, csv or parquet
+    :param model:
+    :param filters: see iter_rows
+    :return: number of rows exported
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, use one of {', '.join(FORMATS)}")
+    # the export only reads, the table and its indexes are created by the monitor, see sql.create_db
+    inspector = inspect(engine)
+    if not inspector.has_table(model.__tablename__):
+        raise ValueError(f"Table {model.__tablename__} doesn't exist, run the monitor once to create it")
+    existing = {index["name"] for index in inspector.get_indexes(model.__tablename__)}
+    for index in model.__table__.indexes:
+        if index.name not in existing:
+            logger.warning(f"Index {index.name} is missing on {model.__tablename__}, the export scans the table, "
+                           f"run the monitor once to add it")
+    pages = iter_rows(engine, model, **filters)
+    if fmt == "parquet":
+        if output == "-":
+            raise ValueError("Parquet can't be written to stdout, set an output file")
+        count = write_parquet(pages, output, model)
+    else:
+        f = sys.stdout if output == "-" else open(output, "w", encoding="utf-8", newline="")
+        try:
+            if fmt == "csv":
+                count = write_csv(pages, f, [column.name for column in model.__table__.columns])
+            else:
+                count = write_ndjson(pages, f)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+    logger.info(f"Exported {count} rows of {model.__tablename__} to {output}")
+    return count
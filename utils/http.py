@@ -0,0 +1,341 @@
+import os
+import time
+import json
+import hashlib
+import threading
+from pathlib import Path
+from loguru import logger
+from typing import Optional
+from utils.metrics import metrics
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from requests.exceptions import ConnectionError, RequestException, Timeout
+
+# statuses retried by ServiceAdapter
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class ResponseCache:
+    """
+    Bounded on-disk store of GET response bodies and their validators (ETag/Last-Modified).
+    Least recently used entries are evicted once the total body size exceeds max_size.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(f.stat().st_size for f in self.cache_dir.glob("*.body"))
+
+    def _path(self, url: str) -> Path:
+        return self.cache_dir / hashlib.sha1(url.encode()).hexdigest()
+
+    def get(self, url: str) -> Optional[dict]:
+        path = self._path(url)
+        try:
+            with open(path.with_suffix(".json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        return meta
+
+    def read_body(self, url: str) -> Optional[bytes]:
+        path = self._path(url).with_suffix(".body")
+        try:
+            content = path.read_bytes()
+        except OSError:
+            return None
+        # touch the entry so that eviction keeps recently used responses
+        os.utime(path)
+        return content
+
+    def set(self, url: str, headers, content: bytes, digest: str):
+        path = self._path(url)
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "content_type": headers.get("Content-Type"),
+            "digest": digest,
+        }
+        with self._lock:
+            body_path = path.with_suffix(".body")
+            if body_path.exists():
+                self._size -= body_path.stat().st_size
+            try:
+                tmp = path.with_suffix(".tmp")
+                tmp.write_bytes(content)
+                os.replace(tmp, body_path)
+                with open(tmp, "w") as f:
+                    json.dump(meta, f)
+                os.replace(tmp, path.with_suffix(".json"))
+            except OSError as e:
+                logger.warning(f"Failed to write HTTP cache for {url}: {e}")
+                return
+            self._size += len(content)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        bodies = sorted(self.cache_dir.glob("*.body"), key=lambda f: f.stat().st_mtime)
+        for body in bodies:
+            if self._size <= self.max_size:
+                break
+            try:
+                size = body.stat().st_size
+                body.unlink()
+                body.with_suffix(".json").unlink(missing_ok=True)
+            except OSError:
+                continue
+            self._size -= size
+        logger.debug(f"HTTP cache evicted to {self._size} bytes")
+
+
+class CircuitOpenError(RequestException):
+    """
+    Request skipped because the circuit breaker of its host is open
+    """
+
+
+class TokenBucket:
+    """
+    Rate limiter of one host, shared by every thread requesting it.
+    A pause (e.g. from Retry-After) holds back every request to the host, not only the one that got it.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: requests per second
+        :param burst: requests that can be made at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Wait for a token
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class CircuitBreaker:
+    """
+    Breaker of one host, opened by consecutive failures so requests fail fast instead of retrying.
+    Once reset_timeout passed, one trial request is let through, its success closes the breaker.
+    """
+
+    def __init__(self, host: str, failure_threshold: int, reset_timeout: float):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half open, the next requests wait for the trial for another reset_timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit breaker of {self.host} closed")
+                metrics.set("sum_http_circuit_open", 0, host=self.host)
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker of {self.host} opened after {self.failures} failures, "
+                               f"requests fail for {self.reset_timeout}s")
+                metrics.set("sum_http_circuit_open", 1, host=self.host)
+            self.opened_at = time.monotonic()
+
+
+# host -> limiter / breaker, shared by every session and service
+_buckets: dict[str, TokenBucket] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_hosts_lock = threading.Lock()
+
+
+def host_bucket(host: str, rate: float, burst: int) -> TokenBucket:
+    with _hosts_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(rate, burst)
+        return _buckets[host]
+
+
+def host_breaker(host: str, failure_threshold: int, reset_timeout: float) -> CircuitBreaker:
+    with _hosts_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host, failure_threshold, reset_timeout)
+        return _breakers[host]
+
+
+def retry_after(response) -> Optional[float]:
+    """
+    Seconds to wait from the Retry-After header, which is either seconds or an HTTP date
+    :param response:
+    :return: None without a valid header
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ServiceAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that rate limits, retries and revalidates requests.
+    Requests are limited per host with a shared TokenBucket, 429/5xx responses and connection errors are retried
+    with backoff or after Retry-After, and a CircuitBreaker per host fails requests fast while the host is down.
+    GET requests are revalidated against a ResponseCache, every response gets a `from_cache` flag and a `digest`
+    of its body, a 304 is served from the cache as a 200.
+    """
+
+    def __init__(self, *args, cache: Optional[ResponseCache] = None, retries: int = 5, backoff_factor: float = 1,
+                 max_backoff: float = 60, rate_limit: Optional[tuple[float, int]] = None,
+                 circuit_breaker: Optional[tuple[int, float]] = None, **kwargs):
+        """
+        :param cache:
+        :param retries: retries of a request
+        :param backoff_factor: the n-th retry waits backoff_factor * 2 ** n seconds
+        :param max_backoff: longest wait before a retry, a longer Retry-After fails the request
+        :param rate_limit: (requests per second, burst) per host, None for unlimited
+        :param circuit_breaker: (failure threshold, reset timeout in seconds) per host, None to disable
+        """
+        self.cache = cache
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limit = rate_limit
+        self.circuit_breaker = circuit_breaker
+        super().__init__(*args, **kwargs)
+
+    def _send(self, request, host: str, *args, **kwargs):
+        bucket = host_bucket(host, *self.rate_limit) if self.rate_limit else None
+        breaker = host_breaker(host, *self.circuit_breaker) if self.circuit_breaker else None
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                raise CircuitOpenError(f"Circuit breaker of {host} is open", request=request)
+            if bucket:
+                bucket.acquire()
+            try:
+                response = super().send(request, *args, **kwargs)
+            except (ConnectionError, Timeout):
+                if breaker:
+                    breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                reason, delay = "error", None
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    if breaker:
+                        breaker.success()
+                    return response
+                # a 429 is the host asking us to slow down, not the host failing
+                if breaker and response.status_code != 429:
+                    breaker.failure()
+                if attempt >= self.retries:
+                    return response
+                reason, delay = str(response.status_code), retry_after(response)
+                response.close()
+            if delay is None:
+                delay = min(self.backoff_factor * 2 ** attempt, self.max_backoff)
+            elif delay > self.max_backoff:
+                logger.warning(f"{host} asked to retry in {delay:.0f}s, longer than {self.max_backoff}s, give up")
+                return response
+            attempt += 1
+            metrics.inc("sum_http_retries_total", host=host, reason=reason)
+            if bucket and reason in ("429", "503"):
+                # every thread backs off together instead of each one hitting the host again
+                bucket.pause(delay)
+            else:
+                time.sleep(delay)
+
+    def send(self, request, *args, **kwargs):
+        entry = None
+        if self.cache and request.method == "GET":
+            entry = self.cache.get(request.url)
+            if entry and entry.get("etag"):
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry and entry.get("last_modified"):
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+        host = urlparse(request.url).hostname
+        response = self._send(request, host, *args, **kwargs)
+        response.from_cache = False
+        response.digest = None
+        if request.method != "GET":
+            return response
+        if entry and response.status_code == 304:
+            # consume the empty body, so the connection goes back to the pool before the content is replaced
+            _ = response.content
+            content = self.cache.read_body(request.url)
+            if content is not None:
+                response.status_code = 200
+                response._content = content
+                response.from_cache = True
+                metrics.inc("sum_http_not_modified_total", host=host)
+                response.digest = entry.get("digest")
+                if entry.get("content_type"):
+                    response.headers["Content-Type"] = entry["content_type"]
+                return response
+            # the body was evicted after the validators were read, fetch the page again unconditionally
+            logger.debug(f"Cached body of {request.url} is gone, fetching it again")
+            request.headers.pop("If-None-Match", None)
+            request.headers.pop("If-Modified-Since", None)
+            response = self._send(request, host, *args, **kwargs)
+            response.from_cache = False
+            response.digest = None
+        if response.status_code == 200:
+            response.digest = hashlib.sha256(response.content).hexdigest()
+            if self.cache and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+                self.cache.set(request.url, response.headers, response.content, response.digest)
+        return response
@@ -0,0 +1,52 @@
+import importlib
+from typing import Iterator, Mapping
+
+
+def resolve(path: str):
+    """
+    Import "package.module:attribute" and return the attribute
+    :param path:
+    :return:
+    """
+    module, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+class LazyMap(Mapping):
+    """
+    Name -> "package.module:attribute" map, a module is only imported when its name is looked up,
+    so plugins that are not enabled cost nothing at startup.
+    """
+
+    def __init__(self, paths: dict[str, str]):
+        self.paths = paths
+        self._loaded: dict[str, object] = {}
+
+    def __getitem__(self, name: str):
+        if name not in self._loaded:
+            self._loaded[name] = resolve(self.paths[name])
+        return self._loaded[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+class LazyAttribute:
+    """
+    Class attribute imported on first access, e.g. the SQL model of a service that only matters with a database.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._value = None
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            self._value = resolve(self.path)
+        return self._value
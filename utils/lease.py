@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import socket
+import threading
+from loguru import logger
+from typing import Iterator, Optional
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy import Engine, String, DateTime, delete, insert, or_, update
+
+
+class LeaseBase(DeclarativeBase):
+    pass
+
+
+class LeaseSQL(LeaseBase):
+    __tablename__ = 'sum_lease'
+    name: Mapped[str] = mapped_column(String(255), primary_key=True, comment="claimed work, e.g. service:Netflix")
+    owner: Mapped[str] = mapped_column(String(255), comment="node holding the lease")
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True, comment="utc time the lease runs out")
+
+    def __repr__(self):
+        return f"Lease({self.name!r}->{self.owner!r} until {self.expires_at!r})"
+
+
+def utcnow() -> datetime:
+    # naive utc, nodes in different time zones compare the same values
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def default_node() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Leases:
+    """
+    Leases of one node, kept as rows of a table shared by every node.
+    A lease is taken with a conditional UPDATE that only matches a free, expired or already owned row,
+    or an INSERT of a new row, so exactly one node gets it. A heartbeat thread extends the leases in use,
+    the leases of a node that died run out after ttl seconds and are free to be taken by the other nodes.
+    """
+
+    def __init__(self, engine: Engine, node: str = "", ttl: float = 60, heartbeat: float = 15, linger: float = 0):
+        """
+        :param engine:
+        :param node: name of this node, unique among the nodes
+        :param ttl: seconds a lease lasts without heartbeat
+        :param heartbeat: seconds between two extensions of the leases in use
+        :param linger: seconds a lease stays taken after its block, see hold
+        """
+        self.engine = engine
+        self.node = node or default_node()
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.linger = linger
+        # name -> blocks holding the lease
+        self.held: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._heartbeat: Optional[threading.Thread] = None
+        LeaseBase.metadata.create_all(engine)
+
+    def acquire(self, name: str) -> bool:
+        """
+        Take a lease, or extend it when this node holds it already
+        :param name:
+        :return: whether this node holds the lease
+        """
+        now = utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        try:
+            with self.engine.begin() as conn:
+                taken = conn.execute(
+                    update(LeaseSQL)
+                    .where(LeaseSQL.name == name, or_(LeaseSQL.owner == self.node, LeaseSQL.expires_at <= now))
+                    .values(owner=self.node, expires_at=expires_at)
+                ).rowcount
+                if not taken:
+                    conn.execute(insert(LeaseSQL).values(name=name, owner=self.node, expires_at=expires_at))
+            return True
+        except IntegrityError:
+            # the row exists, and another node holds it
+            return False
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to acquire lease {name}: {e}")
+            return False
+
+    def release(self, name: str, linger: float = 0):
+        """
+        Give a lease up
+        :param name:
+        :param linger: seconds the lease stays taken, 0 to free it right away
+        :return:
+        """
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    update(LeaseSQL)
+                    .where(LeaseSQL.name == name, LeaseSQL.owner == self.node)
+                    .values(expires_at=utcnow() + timedelta(seconds=linger))
+                )
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to release lease {name}, it runs out in {self.ttl}s: {e}")
+
+    def renew(self):
+        """
+        Extend the leases in use, and drop leases that ran out a day ago
+        :return:
+        """
+        with self._lock:
+            names = list(self.held)
+        now = utcnow()
+        try:
+            with self.engine.begin() as conn:
+                for name in names:
+                    renewed = conn.execute(
+                        update(LeaseSQL)
+                        .where(LeaseSQL.name == name, LeaseSQL.owner == self.node)
+                        .values(expires_at=now + timedelta(seconds=self.ttl))
+                    ).rowcount
+                    if not renewed:
+                        # e.g. this node was paused for longer than ttl, and another node took over
+                        logger.warning(f"Lease {name} was lost by {self.node}")
+                conn.execute(delete(LeaseSQL).where(LeaseSQL.expires_at < now - timedelta(days=1)))
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to renew leases {names}: {e}")
+
+    @contextmanager
+    def hold(self, name: str, linger: Optional[float] = None) -> Iterator[bool]:
+        """
+        Hold a lease for the duration of the block, it's extended by the heartbeat while the block runs
+        :param name:
+        :param linger: seconds the lease stays taken after the block, so a late duplicate run on another node
+            is skipped, defaults to self.linger
+        :return: whether this node holds the lease
+        """
+        with self._lock:
+            nested = name in self.held
+        held = nested or self.acquire(name)
+        if not held:
+            yield False
+            return
+        with self._lock:
+            self.held[name] = self.held.get(name, 0) + 1
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="LeaseHeartbeat", daemon=True)
+                self._heartbeat.start()
+        try:
+            yield True
+        finally:
+            with self._lock:
+                self.held[name] -= 1
+                last = self.held[name] == 0
+                if last:
+                    del self.held[name]
+            if last:
+                self.release(name, self.linger if linger is None else linger)
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            self.renew()
+
+
+# built by get_leases on first use, only when the cluster is enabled
+leases: Optional[Leases] = None
+_lock = threading.Lock()
+
+
+def get_leases() -> Optional[Leases]:
+    """
+    Get the leases of this node, the lease table is created on the first call.
+    :return: None if the cluster is disabled
+    """
+    global leases
+    from utils.config import config
+    from utils.sql import create_service_engine
+    if not config.cluster.enable:
+        return None
+    with _lock:
+        if leases is None:
+            cluster = config.cluster
+            leases = Leases(create_service_engine(cluster.type, cluster.config), cluster.node,
+                            cluster.ttl, cluster.heartbeat, cluster.linger)
+            logger.info(f"Cluster node {leases.node} joined, leases last {leases.ttl}s")
+        return leases
+
+
+def _demo_node(db_path: str, ttl: float, heartbeat: float):
+    from sqlalchemy import create_engine
+    node = Leases(create_engine(f"sqlite:///{db_path}"), ttl=ttl, heartbeat=heartbeat)
+    while True:
+        with node.hold("demo") as held:
+            if held:
+                print(f"{time.strftime('%X')} {node.node} holds the lease", flush=True)
+                # works until it is killed, the heartbeat keeps the lease
+                while True:
+                    time.sleep(heartbeat)
+        time.sleep(heartbeat / 2)
+
+
+if __name__ == '__main__':
+    # several processes compete for one lease in a sqlite file, the holder is killed every few seconds
+    # and the lease moves to a surviving process: python -m utils.lease --nodes 3
+    import argparse
+    import tempfile
+    import multiprocessing
+    from sqlalchemy import create_engine, select
+
+    parser = argparse.ArgumentParser(description="Lease failover between local processes")
+    parser.add_argument("--db", help="sqlite file, a temporary one by default")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--ttl", type=float, default=3)
+    parser.add_argument("--heartbeat", type=float, default=1)
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="sum-lease-"), "lease.db")
+    LeaseBase.metadata.create_all(create_engine(f"sqlite:///{db_path}"))
+    nodes = [multiprocessing.Process(target=_demo_node, args=(db_path, args.ttl, args.heartbeat), daemon=True)
+             for _ in range(args.nodes)]
+    for process in nodes:
+        process.start()
+    engine = create_engine(f"sqlite:///{db_path}")
+    alive = {f"{socket.gethostname()}-{process.pid}": process for process in nodes}
+    while len(alive) > 1:
+        time.sleep(args.ttl * 2)
+        with engine.connect() as conn:
+            owner = conn.execute(select(LeaseSQL.owner).where(LeaseSQL.name == "demo")).scalar()
+        if owner not in alive:
+            print(f"no node holds the lease, owner {owner}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{time.strftime('%X')} killing {owner}", flush=True)
+        alive.pop(owner).kill()
+    time.sleep(args.ttl * 2)
+    for process in alive.values():
+        process.kill()
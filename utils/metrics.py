@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+from loguru import logger
+from functools import wraps
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# name -> (type, help), metrics not listed here are exported as untyped
+METRICS = {
+    "sum_stage_seconds": ("summary", "Time spent per stage"),
+    "sum_pages_fetched_total": ("counter", "Pages fetched from a service"),
+    "sum_bytes_fetched_total": ("counter", "Response bytes fetched from a service"),
+    "sum_http_not_modified_total": ("counter", "Responses served from the HTTP cache after a 304"),
+    "sum_http_retries_total": ("counter", "HTTP retries by reason"),
+    "sum_http_circuit_open": ("gauge", "Whether the circuit breaker of a host is open"),
+    "sum_items_total": ("counter", "Crawled items by dedup state"),
+    "sum_rows_written_total": ("counter", "Rows committed to a database"),
+    "sum_notifications_total": ("counter", "Notification sends by result"),
+    "sum_runs_coalesced_total": ("counter", "Service runs skipped because a run was still in progress"),
+    "sum_runs_claimed_elsewhere_total": ("counter", "Runs skipped because another node claimed them"),
+    "sum_first_delivery_seconds": ("gauge", "Seconds from the start of the last run to its first delivery"),
+    "sum_scheduled_notifications": ("gauge", "Notifications waiting in the dispatcher, outside the outbox"),
+    "sum_outbox_notifications": ("gauge", "Pending and claimed notifications in the outbox"),
+    "sum_db_queue_depth": ("gauge", "Rows waiting in a database writer queue"),
+}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    In-process counters, gauges and stage timers, exported in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value, labels are a sorted tuple of pairs
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        # (name, labels) -> [sum, count]
+        self.summaries: dict[tuple[str, tuple], list[float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self.summaries.setdefault(key, [0.0, 0])
+            summary[0] += value
+            summary[1] += 1
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("sum_stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def timed(self, stage: str):
+        """
+        Decorator timing a service method, labelled with the service class name
+        :param stage:
+        :return:
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(service, *args, **kwargs):
+                with self.timer(stage, service=service.__class__.__name__):
+                    return func(service, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self) -> str:
+        with self._lock:
+            samples: dict[str, list[str]] = {}
+            for (name, labels), value in [*self.counters.items(), *self.gauges.items()]:
+                samples.setdefault(name, []).append(f"{name}{_labels(dict(labels))} {value}")
+            for (name, labels), (total, count) in self.summaries.items():
+                samples.setdefault(name, []).extend([
+                    f"{name}_sum{_labels(dict(labels))} {total}",
+                    f"{name}_count{_labels(dict(labels))} {count}",
+                ])
+        lines = []
+        for name in sorted(samples):
+            metric_type, description = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(sorted(samples[name]))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        """
+        Serve /metrics on a daemon thread
+        :param host:
+        :param port:
+        :return:
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                ...
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Metrics served on http://{host}:{port}/metrics")
+        return server
+
+    def dump(self, path: str):
+        """
+        Write the metrics to a file, e.g. for the node_exporter textfile collector
+        :param path:
+        :return:
+        """
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Failed to write metrics to {path}: {e}")
+
+
+metrics = Metrics()
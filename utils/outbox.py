@@ -0,0 +1,231 @@
+import uuid
+import socket
+from loguru import logger
+from typing import Optional
+from utils.metrics import metrics
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+from utils.config import Outbox as OutboxConfig
+from utils.base_object import Notification, NotificationMSG
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy import Engine, String, Text, DateTime, INT, Index, and_, delete, func, insert, or_, select, update
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+class OutboxBase(DeclarativeBase):
+    pass
+
+
+class OutboxSQL(OutboxBase):
+    __tablename__ = 'sum_outbox'
+    __table_args__ = (
+        Index("ix_sum_outbox_status_next_attempt", "status", "next_attempt"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    sink: Mapped[str] = mapped_column(String(255), comment="notification name")
+    name: Mapped[str] = mapped_column(String(255), comment="message name, a pending message is rescheduled by name")
+    msg: Mapped[str] = mapped_column(Text, comment="NotificationMSG as json")
+    send_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True,
+                                                          comment="scheduled send time, null for immediate messages")
+    status: Mapped[str] = mapped_column(String(16), default=PENDING, comment="pending, sending, sent or dead")
+    attempts: Mapped[int] = mapped_column(INT, default=0, comment="delivery attempts so far")
+    next_attempt: Mapped[datetime] = mapped_column(DateTime, comment="time the message is due")
+    claimed_by: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="claim of the drainer")
+    claimed_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True,
+                                                              comment="claim expiry, retried after it")
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), comment="last status change")
+
+    def __repr__(self):
+        return f"Outbox({self.sink!r}:{self.name!r}->{self.status!r})"
+
+
+class Outbox:
+    """
+    Durable queue of notifications in a database table, the messages survive restarts.
+    Producers append rendered messages, the drainer claims due messages in batches, delivers them and retries
+    failed ones with exponential backoff, a message failing max_attempts times is dead. A claim runs out after
+    claim_timeout, so the messages of a drainer that died are delivered again: delivery is at least once.
+    """
+
+    def __init__(self, engine: Engine, outbox_config: OutboxConfig):
+        self.engine = engine
+        self.config = outbox_config
+        self.node = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        OutboxBase.metadata.create_all(engine)
+
+    def append(self, sink: str, msgs: list[tuple[NotificationMSG, Optional[datetime]]]) -> list[int]:
+        """
+        Add messages, a scheduled message with the name of a pending one of the same sink reschedules it
+        :param sink:
+        :param msgs: (message, send time) pairs, the send time is None for immediate messages
+        :return: ids of the added or rescheduled rows, in the order of msgs
+        """
+        now = datetime.now()
+        ids = []
+        with self.engine.begin() as conn:
+            for msg, send_time in msgs:
+                values = {"msg": msg.model_dump_json(), "send_time": send_time, "next_attempt": send_time or now,
+                          "updated_at": now}
+                if send_time:
+                    pending = and_(OutboxSQL.sink == sink, OutboxSQL.name == msg.name, OutboxSQL.status == PENDING,
+                                   OutboxSQL.send_time.is_not(None))
+                    row_id = conn.execute(select(OutboxSQL.id).where(pending).limit(1)).scalar()
+                    if row_id is not None and conn.execute(
+                            update(OutboxSQL).where(OutboxSQL.id == row_id, pending).values(attempts=0, **values)
+                    ).rowcount:
+                        ids.append(row_id)
+                        continue
+                ids.append(conn.execute(
+                    insert(OutboxSQL).values(sink=sink, name=msg.name, status=PENDING, attempts=0, **values)
+                ).inserted_primary_key[0])
+        self._gauge()
+        return ids
+
+    def drain(self, sinks: dict[str, Notification]) -> list[int]:
+        """
+        Deliver due messages until none is left, scheduled messages are sent in one batch per send time
+        :param sinks: name -> notification, messages of other sinks are left alone
+        :return: ids of the messages sent
+        """
+        sent = []
+        while rows := self._claim(list(sinks)):
+            delivered = []
+            batches: dict[tuple, list] = {}
+            for row in rows:
+                if row.send_time:
+                    batches.setdefault((row.sink, row.send_time), []).append(row)
+                elif sinks[row.sink].config.get("digest"):
+                    # immediate messages of a digest sink are merged per drain
+                    batches.setdefault((row.sink, None), []).append(row)
+                else:
+                    # immediate messages are sent one by one, like they are produced
+                    batches[(row.sink, None, row.id)] = [row]
+            for (sink, send_time, *_), batch in batches.items():
+                msgs = [NotificationMSG.model_validate_json(row.msg) for row in batch]
+                error = None
+                try:
+                    with metrics.timer("send", sink=sink):
+                        ok = sinks[sink].send_batch(msgs)
+                except Exception as e:
+                    ok, error = False, repr(e)
+                sinks[sink].count(ok, len(msgs))
+                if ok:
+                    delivered.extend(batch)
+                    logger.info(f"Send {len(msgs)} notifications to {sink}"
+                                f"{f' scheduled at {send_time}' if send_time else ''} success")
+                else:
+                    self._settle(batch, False, error)
+            # delivered messages are settled together, a crash before that delivers them again
+            if delivered:
+                self._settle(delivered, True)
+                sent.extend(row.id for row in delivered)
+        self._prune()
+        self._gauge()
+        return sent
+
+    def next_due(self, sinks: list[str]) -> Optional[datetime]:
+        """
+        :param sinks: names of the notifications
+        :return: time the next message of the sinks is due, None if there is none
+        """
+        with self.engine.connect() as conn:
+            pending = conn.execute(select(func.min(OutboxSQL.next_attempt))
+                                   .where(OutboxSQL.status == PENDING, OutboxSQL.sink.in_(sinks))).scalar()
+            claimed = conn.execute(select(func.min(OutboxSQL.claimed_until))
+                                   .where(OutboxSQL.status == SENDING, OutboxSQL.sink.in_(sinks))).scalar()
+        return min((t for t in (pending, claimed) if t), default=None)
+
+    def orphans(self, sinks: list[str]) -> dict[str, int]:
+        """
+        Messages waiting for notifications that are not configured anymore, e.g. renamed ones, they are never sent
+        :param sinks: names of the notifications
+        :return: sink -> number of pending messages
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(OutboxSQL.sink, func.count())
+                                .where(OutboxSQL.status.in_((PENDING, SENDING)), OutboxSQL.sink.not_in(sinks))
+                                .group_by(OutboxSQL.sink)).all()
+        return {sink: count for sink, count in rows}
+
+    def _claim(self, sinks: list[str]) -> list:
+        now = datetime.now()
+        claim = f"{self.node}:{uuid.uuid4().hex}"
+        due = or_(
+            and_(OutboxSQL.status == PENDING, OutboxSQL.next_attempt <= now),
+            and_(OutboxSQL.status == SENDING, OutboxSQL.claimed_until < now),
+        )
+        try:
+            with self.engine.begin() as conn:
+                ids = conn.execute(select(OutboxSQL.id).where(due, OutboxSQL.sink.in_(sinks))
+                                   .order_by(OutboxSQL.next_attempt).limit(self.config.batch_size)).scalars().all()
+                if not ids:
+                    return []
+                # another drainer may have claimed some of them in the meantime, due is checked again
+                conn.execute(
+                    update(OutboxSQL).where(OutboxSQL.id.in_(ids), due)
+                    .values(status=SENDING, claimed_by=claim, attempts=OutboxSQL.attempts + 1, updated_at=now,
+                            claimed_until=now + timedelta(seconds=self.config.claim_timeout))
+                )
+                return conn.execute(
+                    select(OutboxSQL.id, OutboxSQL.sink, OutboxSQL.msg, OutboxSQL.send_time, OutboxSQL.attempts)
+                    .where(OutboxSQL.claimed_by == claim, OutboxSQL.status == SENDING).order_by(OutboxSQL.id)
+                ).all()
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to claim notifications from the outbox: {e}")
+            return []
+
+    def _settle(self, rows: list, ok: bool, error: Optional[str] = None):
+        """
+        Mark claimed messages sent, or schedule their retry, or mark them dead once they ran out of attempts
+        :param rows: claimed rows
+        :param ok: whether they were delivered
+        :param error:
+        :return:
+        """
+        now = datetime.now()
+        try:
+            with self.engine.begin() as conn:
+                if ok:
+                    conn.execute(update(OutboxSQL).where(OutboxSQL.id.in_([row.id for row in rows]))
+                                 .values(status=SENT, claimed_by=None, claimed_until=None, updated_at=now))
+                    return
+                for row in rows:
+                    values = {"claimed_by": None, "claimed_until": None, "last_error": error, "updated_at": now}
+                    if row.attempts >= self.config.max_attempts:
+                        logger.error(f"Notification {row.id} to {row.sink} failed {row.attempts} times, "
+                                     f"it is dead: {error or 'not sent'}")
+                        metrics.inc("sum_notifications_total", sink=row.sink, result="dead")
+                        values["status"] = DEAD
+                    else:
+                        delay = min(self.config.backoff * 2 ** (row.attempts - 1), self.config.max_backoff)
+                        logger.warning(f"Notification {row.id} to {row.sink} failed ({row.attempts}/"
+                                       f"{self.config.max_attempts}), retry in {delay:.0f}s: {error or 'not sent'}")
+                        values["status"] = PENDING
+                        values["next_attempt"] = now + timedelta(seconds=delay)
+                    conn.execute(update(OutboxSQL).where(OutboxSQL.id == row.id).values(**values))
+        except SQLAlchemyError as e:
+            # the claim runs out and the messages are delivered again
+            logger.error(f"Failed to settle {len(rows)} notifications in the outbox: {e}")
+
+    def _prune(self):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(OutboxSQL).where(
+                    OutboxSQL.status == SENT, OutboxSQL.updated_at < datetime.now() - timedelta(hours=self.config.retention)
+                ))
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to prune the outbox: {e}")
+
+    def _gauge(self):
+        try:
+            with self.engine.connect() as conn:
+                pending = conn.execute(select(func.count()).select_from(OutboxSQL)
+                                       .where(OutboxSQL.status.in_((PENDING, SENDING)))).scalar()
+            metrics.set("sum_outbox_notifications", pending)
+        except SQLAlchemyError:
+            pass
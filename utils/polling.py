@@ -0,0 +1,106 @@
+import heapq
+import threading
+from loguru import logger
+from datetime import datetime
+from utils.config import Service as ServiceConfig
+
+
+class AdaptivePolling:
+    """
+    Polling interval of one service, driven by what its crawls found.
+    The interval grows exponentially with every crawl without new releases, and shrinks to half of the time
+    left until the next known release starts, so big drops are watched closely. It stays within the bounds.
+    """
+
+    def __init__(self, service_config: ServiceConfig):
+        self.config = service_config
+        # crawls in a row without new releases
+        self.idle_runs = 0
+        # heap of start times of known releases that did not start yet
+        self.upcoming: list[datetime] = []
+        self.interval: float = service_config.interval
+
+    def observe(self, start_times: list[datetime]) -> float:
+        """
+        Account for the releases a crawl found and compute the next interval
+        :param start_times: start times of the new releases of the crawl
+        :return: next interval, in minutes
+        """
+        self.idle_runs = 0 if start_times else self.idle_runs + 1
+        return self.seed(start_times)
+
+    def seed(self, start_times: list[datetime]) -> float:
+        """
+        Remember start times of known releases without counting a crawl, e.g. the ones stored before a restart
+        :param start_times:
+        :return: next interval, in minutes
+        """
+        now = datetime.now()
+        for start_time in start_times:
+            if start_time and start_time > now:
+                heapq.heappush(self.upcoming, start_time)
+        while self.upcoming and self.upcoming[0] <= now:
+            heapq.heappop(self.upcoming)
+
+        # the exponent is capped, the interval is bounded by max_interval anyway
+        interval = self.config.interval * self.config.backoff ** min(self.idle_runs, 32)
+        if self.upcoming:
+            interval = min(interval, (self.upcoming[0] - now).total_seconds() / 60 / 2)
+        # rounded, so an unchanged interval doesn't reschedule the job
+        self.interval = round(min(max(interval, self.config.min_interval), self.config.max_interval), 1)
+        return self.interval
+
+
+_states: dict[str, AdaptivePolling] = {}
+_lock = threading.Lock()
+
+
+def _state(name: str, service_config: ServiceConfig) -> AdaptivePolling:
+    with _lock:
+        if name not in _states:
+            _states[name] = AdaptivePolling(service_config)
+        return _states[name]
+
+
+def observe(name: str, service_config: ServiceConfig, start_times: list[datetime]) -> float:
+    """
+    Account for a crawl of a service, kept in memory for the process so it survives services being
+    reloaded from a persistent job store
+    :param name: service name
+    :param service_config:
+    :param start_times: start times of the new releases of the crawl
+    :return: next interval, in minutes
+    """
+    polling = _state(name, service_config)
+    interval = polling.observe(start_times)
+    logger.info(f"{name} polls again in {interval:.1f} minutes ({polling.idle_runs} idle runs, "
+                f"next known release {polling.upcoming[0] if polling.upcoming else 'unknown'})")
+    return interval
+
+
+def seed(name: str, service_config: ServiceConfig, start_times: list[datetime]) -> float:
+    """
+    Seed the polling state of a service with the upcoming releases stored by earlier runs, they are not new
+    to the next crawl, so without them the state only knows releases found since the start
+    :param name: service name
+    :param service_config:
+    :param start_times: start times of stored releases
+    :return: next interval, in minutes
+    """
+    polling = _state(name, service_config)
+    interval = polling.seed(start_times)
+    if polling.upcoming:
+        logger.info(f"{name} polls every {interval:.1f} minutes, next known release {polling.upcoming[0]}")
+    return interval
+
+
+def interval(name: str, service_config: ServiceConfig) -> float:
+    """
+    Current polling interval of a service
+    :param name: service name
+    :param service_config:
+    :return: minutes
+    """
+    if not service_config.adaptive:
+        return service_config.interval
+    return _state(name, service_config).interval
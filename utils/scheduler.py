@@ -1,49 +1,55 @@
-import os
+import threading
 from loguru import logger
+from typing import Optional
 from utils.config import config
-from urllib.parse import quote_plus
+from utils.sql import create_service_engine
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.schedulers.background import BackgroundScheduler
 
-if config.scheduler.enable:
-    bs_config = {
-        'apscheduler.executors.default': {
-            'class': 'apscheduler.executors.pool:ThreadPoolExecutor',
-            'max_workers': '20'
-        },
-        'apscheduler.executors.processpool': {
-            'type': 'processpool',
-            'max_workers': '5'
-        },
-        'apscheduler.job_defaults.max_instances': '50',
-    }
-    for store in config.scheduler.store:
-        if store.store_backend == "sqlite" and store.store_enable:
-            # it seems that need to dump the model first, is this correct?
-            sqlite_url = f'sqlite:///{store.config.model_dump().get("db_path", "").replace(os.sep, "/")}'
-            bs_config["apscheduler.jobstores.default"] = {
-                'type': 'sqlalchemy',
-                'url': sqlite_url
-            }
-        elif store.store_backend == "mysql" and store.store_enable:
-            config = store.config.model_dump()
-            mysql_url = f"mysql+pymysql://{config.get('user')}:{quote_plus(config.get('password'))}@{config.get('host')}:" \
-                        f"{config.get('port')}/{config.get('db')}?charset=utf8mb4"
-            bs_config["apscheduler.jobstores.default"] = {
-                'type': 'sqlalchemy',
-                'url': mysql_url
-            }
-        else:
-            logger.info("Scheduler store is disabled. Will not store jobs.")
+JOB_DEFAULTS = {"max_instances": 1, "coalesce": True}
+# built and started by get_scheduler on first use, one-shot runs never pay for it
+scheduler: Optional[BackgroundScheduler] = None
+_lock = threading.Lock()
+
 
-    scheduler = BackgroundScheduler(bs_config)
-else:
-    logger.warning("Scheduler is disabled. Will run once and quite.")
-    scheduler = None
+def get_scheduler() -> Optional[BackgroundScheduler]:
+    """
+    Get the background scheduler, it is built and started on the first call.
+    :return: None if the scheduler is disabled
+    """
+    global scheduler
+    if not config.scheduler.enable:
+        return None
+    with _lock:
+        if scheduler:
+            return scheduler
+        bs_config = {
+            'apscheduler.executors.default': {
+                'class': 'apscheduler.executors.pool:ThreadPoolExecutor',
+                'max_workers': '20'
+            },
+            'apscheduler.executors.processpool': {
+                'type': 'processpool',
+                'max_workers': '5'
+            },
+            # a run still in progress when the next one is due isn't doubled, missed runs collapse into one
+            'apscheduler.job_defaults.max_instances': str(JOB_DEFAULTS["max_instances"]),
+            'apscheduler.job_defaults.coalesce': str(JOB_DEFAULTS["coalesce"]).lower(),
+        }
+        for store in config.scheduler.store:
+            if store.store_backend in ("sqlite", "mysql") and store.store_enable:
+                # share the engine tuning of the data databases, e.g. WAL for sqlite
+                bs_config["apscheduler.jobstores.default"] = {
+                    'type': 'sqlalchemy',
+                    'engine': create_service_engine(store.store_backend, store.config)
+                }
+            else:
+                logger.info("Scheduler store is disabled. Will not store jobs.")
 
-if scheduler:
-    scheduler.start()
+        scheduler = BackgroundScheduler(bs_config)
+        scheduler.start()
+        return scheduler
 
 
 def add_job(func, trigger, **kwargs):
@@ -52,26 +58,33 @@ def add_job(func, trigger, **kwargs):
     else:
         name = f"{kwargs.get('kwargs', {}).get('_service', '').__class__.__name__}"
 
-    job = scheduler.get_job(name)
+    _scheduler = get_scheduler()
+    job = _scheduler.get_job(name)
     if job:
+        # jobs stored by older versions keep the defaults they were added with
+        outdated = {k: v for k, v in JOB_DEFAULTS.items() if getattr(job, k) != v}
+        # a persistent job store keeps the arguments pickled by the version that added the job,
+        # they are replaced by the current ones, e.g. the service objects of this process
+        arguments = {k: kwargs[k] for k in ("args", "kwargs") if k in kwargs}
+        job = job.modify(func=func, **arguments, **outdated)
         if isinstance(trigger, IntervalTrigger) and isinstance(job.trigger, IntervalTrigger):
             if trigger.interval == job.trigger.interval:
-                logger.info(f'Job {name} already exists with the same interval, skipping')
+                logger.info(f'Job {name} already exists with the same interval, keeping its schedule')
                 return
             else:
                 logger.info(f'Job {name} already exists with different interval, rescheduling')
-                job.modify(trigger=trigger)
+                job.reschedule(trigger=trigger)
         elif isinstance(trigger, DateTrigger) and isinstance(job.trigger, DateTrigger):
             if trigger.run_date == job.trigger.run_date:
-                logger.info(f'Job {name} already exists with the same run date, skipping')
+                logger.info(f'Job {name} already exists with the same run date, keeping its schedule')
                 return
             else:
                 logger.info(f'Job {name} already exists with different run date, rescheduling')
-                job.modify(trigger=trigger)
+                job.reschedule(trigger=trigger)
         else:
             logger.info(f'Job {name} exists with different trigger type, rescheduling')
-            job.modify(trigger=trigger)
+            job.reschedule(trigger=trigger)
     else:
-        scheduler.add_job(func, trigger, id=name, **kwargs)
+        _scheduler.add_job(func, trigger, id=name, **kwargs)
         logger.info(
             f'Added job {func.__name__}({kwargs.get("kwargs", {}).get("_service", "").__class__.__name__}) with trigger {trigger}')
\ No newline at end of file
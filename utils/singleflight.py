@@ -0,0 +1,46 @@
+import threading
+from utils.config import config
+from typing import ContextManager, Iterator
+from contextlib import contextmanager, nullcontext
+
+
+class SingleFlight:
+    """
+    At most one run per key: a run started while another one of the same key is in progress
+    coalesces into it, i.e. it's skipped, since the run in progress does the same work.
+    """
+
+    def __init__(self):
+        self._running: set[str] = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lead(self, key: str) -> Iterator[bool]:
+        """
+        Claim the key for the duration of the block
+        :param key:
+        :return: whether this run leads, False if another run of the key is in progress
+        """
+        with self._lock:
+            leader = key not in self._running
+            self._running.add(key)
+        try:
+            yield leader
+        finally:
+            if leader:
+                with self._lock:
+                    self._running.discard(key)
+
+
+def claim(name: str) -> ContextManager[bool]:
+    """
+    Claim work for this node, the counterpart of SingleFlight across nodes: with the cluster enabled,
+    exactly one node gets the work, see utils.lease
+    :param name:
+    :return: context manager telling whether this node got the work
+    """
+    if not config.cluster.enable:
+        return nullcontext(True)
+    # sqlalchemy is only imported when the cluster is enabled
+    from utils.lease import get_leases
+    return get_leases().hold(name)
@@ -1,12 +1,20 @@
 import os
+import zlib
 from typing import Union
 from loguru import logger
+from functools import partial
 from datetime import datetime
 from urllib.parse import quote_plus
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import String, DateTime, INT
 from utils.config import DBConfig, SQLiteConfig
-from sqlalchemy import create_engine, func, inspect
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session, sessionmaker
+from sqlalchemy import create_engine, event, func, inspect, insert, select, tuple_, update, Index
+
+# max rows per INSERT statement
+BATCH_SIZE = 500
 
 
 def create_service_engine(backend: str, db_config: Union[DBConfig, SQLiteConfig]):
@@ -14,10 +22,23 @@ def create_service_engine(backend: str, db_config: Union[DBConfig, SQLiteConfig]
         config = db_config.model_dump()
         __sql_url = f"mysql+pymysql://{config.get('user')}:{quote_plus(config.get('password'))}@{config.get('host')}:" \
                     f"{config.get('port')}/{config.get('db')}?charset=utf8mb4"
-        return create_engine(__sql_url, echo=False)
+        return create_engine(__sql_url, echo=False, pool_size=db_config.pool_size,
+                             max_overflow=db_config.max_overflow, pool_pre_ping=db_config.pool_pre_ping,
+                             pool_recycle=db_config.pool_recycle)
     elif backend == "sqlite":
         __sql_url = f'sqlite:///{db_config.model_dump().get("db_path", "").replace(os.sep, "/")}'
-        return create_engine(__sql_url, echo=False)
+        engine = create_engine(__sql_url, echo=False)
+        event.listen(engine, "connect", partial(set_sqlite_pragma, db_config))
+        return engine
+
+
+def set_sqlite_pragma(db_config: SQLiteConfig, dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={db_config.journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={db_config.synchronous}")
+    cursor.execute(f"PRAGMA cache_size={int(db_config.cache_size)}")
+    cursor.execute(f"PRAGMA mmap_size={int(db_config.mmap_size)}")
+    cursor.close()
 
 
 class Base(DeclarativeBase):
@@ -36,20 +57,54 @@ class ServiceBase(Base):
 
 class NetflixSQL(ServiceBase):
     __tablename__ = 'netflix_service'
+    __table_args__ = (
+        Index("uq_netflix_service_video_country", "video_id", "country", unique=True),
+        # keyset pagination and date ranges of exports, see utils.export
+        Index("ix_netflix_service_release_time", "release_time", "id"),
+    )
     video_id: Mapped[int] = mapped_column(INT, nullable=True, comment="netflix title id")
     genre: Mapped[str] = mapped_column(INT, nullable=True, comment="genre id")
     collection: Mapped[str] = mapped_column(INT, nullable=True, comment="collection id")
     country: Mapped[str] = mapped_column(String(255), nullable=True, comment="country name, seems that always US")
+    regions: Mapped[str] = mapped_column(String(255), nullable=True,
+                                         comment="comma separated countries the release was found in")
 
     def __repr__(self):
         return f"Netflix({self.name!r}->{self.release_time!r})"
 
 
+# table name -> model, used to restore rows spilled to disk
+SERVICE_SQL_CLASSES = {NetflixSQL.__tablename__: NetflixSQL}
+# urls of the engines whose schema is up to date
+_bootstrapped: set[str] = set()
+
+
+def schema_version() -> int:
+    """
+    Fingerprint of the tables, columns and indexes declared in Base, fits in sqlite user_version
+    :return:
+    """
+    schema = sorted(
+        f"{t.name}:{','.join(c.name for c in t.columns)}:{','.join(sorted(i.name for i in t.indexes))}"
+        for t in Base.metadata.sorted_tables
+    )
+    return zlib.crc32(";".join(schema).encode()) & 0x7fffffff
+
+
 def create_db(engine):
     if not engine:
         logger.error("No engine provided")
         return
-    service_sql_classes = [NetflixSQL]
+    if str(engine.url) in _bootstrapped:
+        return
+    version = schema_version()
+    if engine.dialect.name == "sqlite":
+        # the schema fingerprint is kept in the database file, so restarts skip the inspection
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA user_version").scalar() == version:
+                _bootstrapped.add(str(engine.url))
+                return
+    service_sql_classes = list(SERVICE_SQL_CLASSES.values())
 
     inspector = inspect(engine)
     tables = inspector.get_table_names()
@@ -57,6 +112,94 @@ def create_db(engine):
     for s in service_sql_classes:
         if s.__tablename__ not in tables:
             Base.metadata.create_all(engine)
+            continue
+        # tables created by older versions miss the columns and indexes added since
+        columns = {column["name"] for column in inspector.get_columns(s.__tablename__)}
+        for column in s.__table__.columns:
+            if column.name in columns:
+                continue
+            if not column.nullable:
+                logger.error(f"Column {column.name} is missing in {s.__tablename__} and can't be added")
+                return
+            quote = engine.dialect.identifier_preparer.quote
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f"ALTER TABLE {quote(s.__tablename__)} ADD COLUMN {quote(column.name)} "
+                                     f"{column.type.compile(engine.dialect)}")
+        existing = {index["name"] for index in inspector.get_indexes(s.__tablename__)}
+        for index in s.__table__.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(engine)
+            except SQLAlchemyError as e:
+                logger.error(f"Failed to create index {index.name} on {s.__tablename__}, remove duplicated rows: {e}")
+                return
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {version}")
+    _bootstrapped.add(str(engine.url))
+
+
+def upsert(dialect: str, model: type[ServiceBase], rows: list[dict], keys: tuple[str, ...]):
+    """
+    Build a multi-row INSERT that updates the existing row on a unique key conflict
+    :param dialect: sqlalchemy dialect name
+    :param model:
+    :param rows:
+    :param keys: columns of the unique index
+    :return:
+    """
+    columns = [c for c in rows[0] if c not in keys]
+    if dialect == "sqlite":
+        stmt = sqlite_insert(model).values(rows)
+        return stmt.on_conflict_do_update(index_elements=list(keys), set_={c: stmt.excluded[c] for c in columns})
+    elif dialect == "mysql":
+        stmt = mysql_insert(model).values(rows)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns})
+    return insert(model).values(rows)
+
+
+def get_upsert_queries(session: Session, model: type[ServiceBase], rows: list[dict],
+                       keys: tuple[str, ...] = ("video_id", "country")) -> list:
+    """
+    Skip rows already stored with one existence check per batch, and build upserts for the rest.
+    A row with an "_update" list of columns is a changed release, its stored row gets an UPDATE of those columns.
+    A row with a "_match" list of columns only updates the stored rows matching those columns, nothing is inserted.
+    :param session:
+    :param model:
+    :param rows:
+    :param keys: columns of the unique index
+    :return:
+    """
+    queries = []
+    key_columns = [getattr(model, k) for k in keys]
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch, matched = [], []
+        for row in rows[i:i + BATCH_SIZE]:
+            if row.get("_match"):
+                matched.append(update(model).where(*[getattr(model, c) == row[c] for c in row["_match"]])
+                               .values({c: row[c] for c in row["_update"]}))
+            else:
+                batch.append(row)
+        if not batch:
+            queries.extend(matched)
+            continue
+        batch_keys = [tuple(row[k] for k in keys) for row in batch]
+        existing = set(session.execute(select(*key_columns).where(tuple_(*key_columns).in_(batch_keys))).tuples())
+        inserts = []
+        for row, key in zip(batch, batch_keys):
+            columns = row.get("_update")
+            if key not in existing:
+                inserts.append({c: v for c, v in row.items() if c != "_update"})
+            elif columns:
+                queries.append(
+                    update(model).where(*[c == v for c, v in zip(key_columns, key)]).values({c: row[c] for c in columns})
+                )
+        if inserts:
+            queries.append(upsert(session.bind.dialect.name, model, inserts, keys))
+        # the rows they update may be inserted by the same batch
+        queries.extend(matched)
+    return queries
 
 
 def get_session(engine):
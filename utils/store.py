@@ -0,0 +1,139 @@
+import time
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable, Iterator, Optional
+
+
+class Release:
+    """
+    Compact, normalised release record, only the fields used by notifications and databases are kept.
+    """
+    __slots__ = ("key", "video_id", "title", "start_time", "genre", "collection", "country", "image", "regions",
+                 "change", "created", "rendered")
+
+    def __init__(self, key: str, video_id: int = 0, title: str = "", start_time: Optional[datetime] = None,
+                 genre: int = 0, collection: int = 0, country: str = "", image: str = "",
+                 regions: Optional[list[str]] = None, change: str = "new"):
+        self.key = key
+        self.video_id = video_id
+        self.title = title
+        self.start_time = start_time
+        self.genre = genre
+        self.collection = collection
+        self.country = country
+        self.image = image
+        # countries the release was found in
+        self.regions = regions or []
+        # new, rescheduled (start time changed) or updated (other fields changed) release,
+        # or regions (a known release found in another region, only stored)
+        self.change = change
+        self.created = time.time()
+        # msg_format -> message, shared by every sink using that format
+        self.rendered: Optional[dict] = None
+
+    def __repr__(self):
+        return f"Release({self.title!r}->{self.start_time!r})"
+
+
+class ReleaseStore:
+    """
+    Append-only queue of releases with one cursor per sink.
+    Releases consumed by every sink are evicted once they are older than the retention.
+    """
+
+    def __init__(self, retention: int = 0):
+        """
+        :param retention: minutes to keep releases after every sink consumed them
+        """
+        self.retention = retention
+        self.records: deque[Release] = deque()
+        # absolute position of self.records[0]
+        self.offset = 0
+        # sink name -> absolute position up to which the sink has consumed
+        self.cursors: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # services are pickled into the scheduler job store
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[Release]:
+        with self._lock:
+            return iter(list(self.records))
+
+    @property
+    def total(self) -> int:
+        """
+        Absolute position after the last release, i.e. number of releases ever appended
+        """
+        return self.offset + len(self.records)
+
+    def since(self, position: int) -> list[Release]:
+        """
+        Get the releases appended after an absolute position that are still kept
+        :param position: value of self.total before
+        :return:
+        """
+        with self._lock:
+            return list(itertools.islice(self.records, max(position - self.offset, 0), None))
+
+    def append(self, record: Release) -> int:
+        """
+        :param record:
+        :return: absolute position of the release
+        """
+        with self._lock:
+            self.records.append(record)
+            return self.offset + len(self.records) - 1
+
+    def modify(self, position: int, func: Callable[[Release], None]) -> bool:
+        """
+        Change a release that no sink has consumed yet, so every sink sees the same release
+        :param position: absolute position of the release
+        :param func: called with the release
+        :return: False if a sink consumed the release already or it was evicted
+        """
+        with self._lock:
+            index = position - self.offset
+            if index < 0 or index >= len(self.records) or position < max(self.cursors.values(), default=self.offset):
+                return False
+            func(self.records[index])
+            return True
+
+    def pending(self, sink: str) -> list[Release]:
+        """
+        Get the releases a sink has not consumed yet and move its cursor to the end.
+        :param sink: sink name
+        :return:
+        """
+        with self._lock:
+            end = self.offset + len(self.records)
+            start = max(self.cursors.get(sink, self.offset), self.offset)
+            self.cursors[sink] = end
+            return list(itertools.islice(self.records, start - self.offset, None))
+
+    def evict(self) -> int:
+        """
+        Drop releases that every known sink has consumed and that are older than the retention.
+        :return: number of evicted releases
+        """
+        with self._lock:
+            consumed = min(self.cursors.values(), default=self.offset + len(self.records))
+            deadline = time.time() - self.retention * 60
+            count = 0
+            while self.records and self.offset < consumed and self.records[0].created <= deadline:
+                self.records.popleft()
+                self.offset += 1
+                count += 1
+            return count
@@ -0,0 +1,28 @@
+from string import Template
+
+
+class Renderer:
+    """
+    Message templates per format (text, markdown, html), compiled once.
+    Templates use $field placeholders, unknown formats fall back to text.
+    """
+
+    def __init__(self, defaults: dict[str, dict[str, str]], overrides: dict[str, dict[str, str]] = None):
+        """
+        :param defaults: format -> {"title": ..., "body": ...}
+        :param overrides: same shape as defaults, a missing title or body keeps the default one
+        """
+        self.templates: dict[str, tuple[Template, Template]] = {}
+        overrides = overrides or {}
+        for msg_format in set(defaults) | set(overrides):
+            template = {**defaults.get(msg_format, defaults["text"]), **overrides.get(msg_format, {})}
+            self.templates[msg_format] = (Template(template["title"]), Template(template["body"]))
+
+    def render(self, fields: dict, msg_format: str) -> tuple[str, str]:
+        """
+        :param fields: placeholder values
+        :param msg_format:
+        :return: title and body
+        """
+        title, body = self.templates.get(msg_format, self.templates["text"])
+        return title.safe_substitute(fields), body.safe_substitute(fields)
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+from pathlib import Path
+from loguru import logger
+from datetime import datetime
+from utils.config import d, DB
+from utils.metrics import metrics
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.session import sessionmaker
+from utils.sql import ServiceBase, SERVICE_SQL_CLASSES, get_upsert_queries
+
+
+class DBWriter(threading.Thread):
+    """
+    Write-behind queue of one database.
+    Rows are committed in batches by size and time, failed batches are retried with backoff,
+    and rows that can't be queued or written are spilled to a local file and replayed later.
+    """
+
+    def __init__(self, session_maker: sessionmaker, db_config: DB):
+        self.session_maker = session_maker
+        self.url = session_maker.kw.get("bind").url
+        # sink name of this database, see Service.pending
+        self.sink = f"sql_{self.url}"
+        super().__init__(name=f"DBWriter({self.url})", daemon=True)
+        self.config = db_config
+        self.queue: queue.Queue = queue.Queue(maxsize=db_config.queue_size)
+        self.spill_path = Path(d.spill) / f"{hashlib.sha1(str(self.url).encode()).hexdigest()}.ndjson"
+        self._spill_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def put(self, model: type[ServiceBase], rows: list[dict], timeout: float = 0):
+        """
+        Queue rows, rows that don't fit are spilled to disk.
+        :param model:
+        :param rows:
+        :param timeout: seconds to wait for room in the queue before spilling, 0 to spill right away
+        :return:
+        """
+        if self._stopping.is_set():
+            # nothing takes rows from the queue anymore, e.g. a run finishing during shutdown
+            self.spill([(model, row) for row in rows])
+            return
+        for i, row in enumerate(rows):
+            try:
+                self.queue.put((model, row), timeout=timeout) if timeout else self.queue.put_nowait((model, row))
+            except queue.Full:
+                logger.warning(f"{self.sink} write queue is full, spilling {len(rows) - i} rows to {self.spill_path}")
+                self.spill([(model, r) for r in rows[i:]])
+                break
+        metrics.set("sum_db_queue_depth", self.queue.qsize(), db=str(self.url))
+
+    def stop(self, timeout: float = 30):
+        """
+        Write what is queued and stop, rows left over are spilled to disk.
+        :param timeout:
+        :return:
+        """
+        self._stopping.set()
+        try:
+            # wake up the writer if it's waiting for rows
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.join(timeout)
+        left = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                left.append(item)
+        if left:
+            self.spill(left)
+
+    def run(self):
+        self.replay()
+        while True:
+            batch = self._collect()
+            if batch:
+                try:
+                    written = self.write(batch)
+                except Exception as e:
+                    # e.g. a driver error outside SQLAlchemy or a bad row, the writer must outlive it
+                    logger.exception(f"{self.sink} write failed: {e!r}")
+                    written = False
+                if written:
+                    self.replay()
+                else:
+                    self.spill(batch)
+            elif self._stopping.is_set():
+                break
+
+    def _collect(self) -> list[tuple]:
+        batch = []
+        deadline = time.monotonic() + self.config.flush_interval
+        while len(batch) < self.config.batch_size:
+            # don't wait for more rows once stopping, just drain the queue
+            timeout = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def write(self, batch: list[tuple]) -> bool:
+        grouped: dict[type[ServiceBase], list[dict]] = {}
+        for model, row in batch:
+            grouped.setdefault(model, []).append(row)
+        for attempt in range(self.config.max_retries):
+            session = self.session_maker()
+            try:
+                with metrics.timer("db_commit", db=str(self.url)):
+                    for model, rows in grouped.items():
+                        for q in get_upsert_queries(session, model, rows):
+                            session.execute(q)
+                    session.commit()
+                metrics.inc("sum_rows_written_total", len(batch), db=str(self.url))
+                metrics.set("sum_db_queue_depth", self.queue.qsize(), db=str(self.url))
+                logger.debug(f"{self.sink} committed {len(batch)} rows")
+                return True
+            except SQLAlchemyError as e:
+                session.rollback()
+                delay = min(2 ** attempt, 60)
+                logger.error(f"{self.sink} write failed ({attempt + 1}/{self.config.max_retries}), "
+                             f"retry in {delay}s: {e}")
+                if self._stopping.wait(delay):
+                    break
+            finally:
+                session.close()
+        return False
+
+    def spill(self, batch: list[tuple]):
+        with self._spill_lock:
+            try:
+                os.makedirs(self.spill_path.parent, exist_ok=True)
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    for model, row in batch:
+                        f.write(json.dumps({"table": model.__tablename__, "row": row}, default=datetime.isoformat,
+                                           ensure_ascii=False) + "\n")
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"{self.sink} failed to spill {len(batch)} rows, rows are lost: {e}")
+
+    def replay(self):
+        """
+        Queue rows spilled by previous runs again.
+        :return:
+        """
+        with self._spill_lock:
+            if not self.spill_path.exists():
+                return
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+            os.remove(self.spill_path)
+        logger.info(f"{self.sink} replaying {len(lines)} spilled rows")
+        for line in lines:
+            try:
+                item = json.loads(line)
+                model = SERVICE_SQL_CLASSES[item["table"]]
+                row = item["row"]
+                for column in model.__table__.columns:
+                    if row.get(column.name) and column.type.python_type is datetime:
+                        row[column.name] = datetime.fromisoformat(row[column.name])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"{self.sink} dropped a spilled row it can't read: {e!r}")
+                continue
+            self.put(model, [row])